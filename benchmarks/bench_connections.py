@@ -0,0 +1,147 @@
+"""Connection scaling of the async server with each poller.
+
+    python benchmarks/bench_connections.py [max connections]
+
+For 10 to 10,000 concurrent connections (as the fd limit allows) it runs
+the server in a child process and measures:
+
+- idle: latency of requests on one connection while the others are open
+  and idle, what a select loop pays for on every iteration;
+- active: requests per second with every connection sending requests
+  back to back.
+"""
+import os
+import sys
+import time
+import errno
+import select
+import signal
+import socket
+import resource
+
+sys.path.insert(0, 'src')
+from trabant import async_server
+
+REQUEST = 'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n'
+POLLERS = [
+    ('epoll', hasattr(select, 'epoll') and async_server.EpollPoller),
+    ('poll', async_server.PollPoller),
+    ('select', async_server.SelectPoller),
+]
+
+def app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return ['hello']
+
+def serve(poller):
+    """Run a server with `poller` in a child process, return its pid and
+    port."""
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid:
+        os.close(write)
+        port = int(os.read(read, 16))
+        os.close(read)
+        return pid, port
+    os.close(read)
+    loop = async_server.EventLoop(poller())
+    server = async_server.HTTPServer(app, '127.0.0.1', 0, loop=loop,
+            max_requests=10 ** 9, keep_alive_timeout=300, backlog=1024)
+    os.write(write, str(server.socket.getsockname()[1]))
+    async_server.loop(1.0, loop)
+    os._exit(0)
+
+def connect(port, n):
+    socks = []
+    for i in range(n):
+        sock = socket.create_connection(('127.0.0.1', port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        socks.append(sock)
+    return socks
+
+def read_response(sock):
+    data = ''
+    while not data.endswith('hello'):
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise IOError('connection closed')
+        data += chunk
+
+def idle(socks, requests=500):
+    sock = socks[0]
+    times = []
+    for i in range(requests):
+        start = time.time()
+        sock.sendall(REQUEST)
+        read_response(sock)
+        times.append(time.time() - start)
+    times.sort()
+    return times[len(times) // 2] * 1e6, times[int(len(times) * .99)] * 1e6
+
+def active(socks, rounds=5):
+    poller = select.epoll() if hasattr(select, 'epoll') else None
+    fds = dict((sock.fileno(), sock) for sock in socks)
+    for fd in fds:
+        fds[fd].setblocking(0)
+        if poller:
+            poller.register(fd, select.EPOLLIN)
+    start = time.time()
+    done = 0
+    for i in range(rounds):
+        for sock in socks:
+            sock.send(REQUEST)
+        waiting = set(fds)
+        buffers = dict.fromkeys(fds, '')
+        while waiting:
+            if poller:
+                ready = [fd for fd, mask in poller.poll(5)]
+            else:
+                ready = [s.fileno() for s in
+                        select.select([fds[fd] for fd in waiting], [], [],
+                            5)[0]]
+            for fd in ready:
+                if fd not in waiting:
+                    continue
+                try:
+                    buffers[fd] += fds[fd].recv(4096)
+                except socket.error, e:
+                    if e.args[0] != errno.EAGAIN:
+                        raise
+                if buffers[fd].endswith('hello'):
+                    waiting.discard(fd)
+                    done += 1
+    for sock in socks:
+        sock.setblocking(1)
+    if poller:
+        poller.close()
+    return done / (time.time() - start)
+
+def run(name, poller, n):
+    pid, port = serve(poller)
+    try:
+        socks = connect(port, n)
+        p50, p99 = idle(socks)
+        rps = active(socks)
+        print '%-6s %6d conns  idle p50 %7.0fus p99 %7.0fus  active %7.0f req/s' % (
+                name, n, p50, p99, rps)
+        for sock in socks:
+            sock.close()
+    finally:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+if __name__ == '__main__':
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    limit = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    limit = min(limit, hard - 64)
+    for n in (10, 100, 1000, 10000):
+        n = min(n, limit)
+        for name, poller in POLLERS:
+            if not poller:
+                continue
+            if name == 'select' and n >= 1000:
+                continue # FD_SETSIZE
+            run(name, poller, n)
+        if n == limit:
+            break
@@ -0,0 +1,118 @@
+"""Fuzz the `RequestParser` and compare its speed with the old readlines
+based head parsing.
+
+    python benchmarks/bench_parser.py [fuzz iterations]
+
+The fuzzer feeds mutated requests split at random points and checks that
+the parser either completes, with the same result whatever the split, or
+raises `ParseError` - never anything else - and that limits hold.
+"""
+import sys
+import random
+import timeit
+from StringIO import StringIO
+
+sys.path.insert(0, 'src')
+from trabant import utils
+from trabant.httpparser import RequestParser, ParseError
+
+REQUEST = ('GET /search/caf%C3%A9?q=trabant&page=2 HTTP/1.1\r\n'
+        'Host: localhost:8080\r\n'
+        'User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:10.0) Gecko Firefox\r\n'
+        'Accept: text/html,application/xhtml+xml,application/xml;q=0.9\r\n'
+        'Accept-Language: en-us,en;q=0.5\r\n'
+        'Accept-Encoding: gzip, deflate\r\n'
+        'Cookie: session=0123456789abcdef; theme=dark\r\n'
+        'Connection: keep-alive\r\n'
+        '\r\n')
+
+def old_parse(data):
+    # what async_server's _prepare_environ used to do
+    environ = {}
+    lines = [line for line in StringIO(data).readlines() if line.strip()]
+    method, url, protocol = lines.pop(0).split()
+    path, query = utils.splitquery(url)
+    environ['REQUEST_METHOD'] = method.upper()
+    environ['PATH_INFO'] = path
+    environ['QUERY_STRING'] = query
+    environ['SERVER_PROTOCOL'] = protocol
+    for line in lines:
+        k, v = map(str.strip, line.split(':', 1))
+        header = '_'.join(k.split('-')).upper()
+        if header not in ('CONTENT_LENGTH', 'CONTENT_TYPE'):
+            header = 'HTTP_%s' % header
+        environ[header] = v
+    return environ
+
+def parse(data, splits=(), **limits):
+    parser = RequestParser(**limits)
+    start = 0
+    rest = ''
+    for end in sorted(splits) + [len(data)]:
+        rest = parser.feed(data[start:end])
+        start = end
+        if parser.complete:
+            rest += data[start:]
+            break
+    return parser, rest
+
+def mutate(data, rnd):
+    data = list(data)
+    for i in range(rnd.randint(1, 8)):
+        op = rnd.random()
+        pos = rnd.randrange(len(data) + 1)
+        if op < 0.3 and data:
+            del data[min(pos, len(data) - 1)]
+        elif op < 0.6:
+            data.insert(pos, rnd.choice(' :\r\n\t\x00/?%HTTP'))
+        elif op < 0.8:
+            data.insert(pos, chr(rnd.randrange(256)))
+        else:
+            data[pos:pos] = list(rnd.choice(['\r\n', 'X-A: b\r\n',
+                'Content-Length: 1x\r\n', ' folded\r\n', 'a' * 9000]))
+    return ''.join(data)
+
+def fuzz(iterations, seed=0):
+    rnd = random.Random(seed)
+    limits = {'max_request_line': 256, 'max_header_bytes': 1024,
+            'max_headers': 12}
+    outcomes = {}
+    for i in range(iterations):
+        data = mutate(REQUEST + 'body', rnd)
+        results = []
+        for attempt in range(3):
+            splits = [rnd.randrange(len(data) + 1)
+                    for j in range(rnd.randint(0, 6))]
+            try:
+                parser, rest = parse(data, splits, **limits)
+            except ParseError, e:
+                assert e.status_code in (400, 414, 431, 501, 505), e.status_code
+                results.append(e.status_code)
+                continue
+            if parser.complete:
+                assert len(parser.headers) <= limits['max_headers']
+                head = len(data) - len(rest)
+                assert head - len(parser.target) <= \
+                        limits['max_request_line'] + limits['max_header_bytes']
+                results.append((parser.environ, rest))
+            else:
+                results.append(None)
+        assert results.count(results[0]) == len(results), repr(data)
+        key = isinstance(results[0], tuple) and 'ok' or results[0]
+        outcomes[key] = outcomes.get(key, 0) + 1
+    print 'fuzz: %d requests, outcomes %r' % (iterations, outcomes)
+
+def bench(number=20000):
+    old = timeit.timeit(lambda: old_parse(REQUEST), number=number)
+    new = timeit.timeit(lambda: parse(REQUEST), number=number)
+    lines = REQUEST.splitlines(True)
+    fed = timeit.timeit(lambda: parse(REQUEST,
+        [sum(map(len, lines[:i])) for i in range(1, len(lines))]),
+        number=number)
+    print 'readlines  %8.0f parses/s' % (number / old)
+    print 'parser     %8.0f parses/s  (whole head)' % (number / new)
+    print 'parser     %8.0f parses/s  (line by line)' % (number / fed)
+
+if __name__ == '__main__':
+    fuzz(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
+    bench()
@@ -0,0 +1,37 @@
+"""Compare the compiled `Router` against the old per-request route loop.
+
+    python benchmarks/bench_routing.py
+"""
+import re
+import sys
+import timeit
+
+sys.path.insert(0, 'src')
+from trabant.wsgiadaptor import Router
+
+
+def make_routes(n):
+    return [('^/r%d/(?P<id>\d+)$' % i, i) for i in range(n)]
+
+def loop_match(routes, path):
+    # what App.__call__ used to do on every request
+    for pattern, func in routes:
+        match = re.search(pattern, path)
+        if match:
+            return func, match.groupdict()
+    return None, None
+
+def run(n, number=2000):
+    routes = make_routes(n)
+    router = Router(routes)
+    paths = ['/r0/1', '/r%d/1' % (n // 2), '/r%d/1' % (n - 1), '/missing']
+    for path in paths:
+        assert loop_match(routes, path) == router.match(path), path
+        old = timeit.timeit(lambda: loop_match(routes, path), number=number)
+        new = timeit.timeit(lambda: router.match(path), number=number)
+        print '%5d routes %-12s loop %8.2fus  router %8.2fus  x%.1f' % (n,
+                path, old / number * 1e6, new / number * 1e6, old / new)
+
+if __name__ == '__main__':
+    for n in (10, 100, 1000):
+        run(n, number=20000 // n)
@@ -0,0 +1,149 @@
+"""Compare template rendering with the optimizing code generator against
+the one it replaced.
+
+    python benchmarks/bench_templates.py
+
+The old generator emitted a `_printlist([...])` call per run of text
+lines, with a constant per line, ran the template as module level code and
+escaped through `touni` and `cgi.escape`.
+"""
+import re
+import cgi
+import sys
+import timeit
+
+sys.path.insert(0, 'src')
+from trabant.template import Template
+from trabant.utils import touni
+
+PAGE = '''<!DOCTYPE html>
+<html>
+<head>
+  <title>{{title}}</title>
+  <link rel="stylesheet" href="/static/style.css">
+</head>
+<body>
+  <div id="header">
+    <h1>{{title}}</h1>
+    <p class="subtitle">Device status, refreshed every {{refresh}} seconds</p>
+  </div>
+  <div id="content">
+    <p>{{message}}</p>
+  </div>
+  <div id="footer">trabant {{version}}</div>
+</body>
+</html>
+'''
+
+TABLE = '''<table>
+  <tr><th>Sensor</th><th>Value</th><th>Unit</th><th>Updated</th></tr>
+%for name, value, unit, updated in rows:
+  <tr class="{{'alert' if value > 90 else 'ok'}}">
+    <td>{{name}}</td><td>{{value}}</td><td>{{unit}}</td><td>{{updated}}</td>
+  </tr>
+%end
+</table>
+'''
+
+MENU = '''<ul class="menu">
+%for label, url in items:
+  %if url == current:
+  <li class="current"><a href="{{url}}">{{label}}</a></li>
+  %else:
+  <li><a href="{{url}}">{{label}}</a></li>
+  %end
+%end
+</ul>
+'''
+
+CASES = [
+    ('page', PAGE, dict(title='Living room', refresh=30, version='0.0.1',
+        message='All sensors <ok> & running')),
+    ('table', TABLE, dict(rows=[('sensor %d' % i, i, u'\xb0C',
+        '2012-03-04 10:%02d' % (i % 60)) for i in range(100)])),
+    ('menu', MENU, dict(current='/status', items=[(u'Item %d' % i,
+        '/page/%d' % i) for i in range(20)] + [('Status', '/status')])),
+]
+
+
+class LegacyTemplate(Template):
+    """The code generator and render loop `Template` used to have, for the
+    templates above (no `%include`, `%rebase` or streaming)."""
+
+    def prepare(self, escape_func=cgi.escape, noescape=False):
+        self.code = self.translate(self.source)
+        self.co = compile(self.code, '<string>', 'exec')
+        enc = self.encoding
+        self._str = lambda x: touni(x, enc)
+        self._escape = lambda x: escape_func(touni(x, enc))
+
+    def translate(self, template, stream=False):
+        stack, ptrbuffer, codebuffer = [], [], []
+
+        def yield_tokens(line):
+            for i, part in enumerate(re.split(r'\{\{(.*?)\}\}', line)):
+                if i % 2:
+                    if part.startswith('!'): yield 'RAW', part[1:]
+                    else: yield 'CMD', part
+                else: yield 'TXT', part
+
+        def flush():
+            if not ptrbuffer: return
+            cline = ''
+            for line in ptrbuffer:
+                for token, value in line:
+                    if token == 'TXT': cline += repr(value)
+                    elif token == 'RAW': cline += '_str(%s)' % value
+                    elif token == 'CMD': cline += '_escape(%s)' % value
+                    cline +=  ', '
+                cline = cline[:-2] + '\\\n'
+            cline = cline[:-2]
+            del ptrbuffer[:]
+            code('_printlist([' + cline + '])')
+
+        def code(stmt):
+            for line in stmt.splitlines():
+                codebuffer.append('  ' * len(stack) + line.strip())
+
+        for line in template.splitlines(True):
+            line = unicode(line, encoding=self.encoding) \
+                    if isinstance(line, str) else line
+            if line.strip()[:2].count('%') == 1:
+                line = line.split('%', 1)[1].lstrip()
+                cmd = re.split(r'[^a-zA-Z0-9_]', line.strip())[0]
+                flush()
+                if cmd in self.blocks:
+                    if cmd in self.dedent_blocks:
+                        stack.pop()
+                    code(line)
+                    stack.append(cmd)
+                elif cmd == 'end' and stack:
+                    code('#end(%s)' % stack.pop())
+                else:
+                    code(line)
+            else:
+                ptrbuffer.append(yield_tokens(line))
+        flush()
+        return '\n'.join(codebuffer) + '\n'
+
+    def execute(self, _stdout, *args, **kwargs):
+        for dictarg in args: kwargs.update(dictarg)
+        env = self.defaults.copy()
+        env.update({'_stdout': _stdout, '_printlist': _stdout.extend,
+               '_str': self._str, '_escape': self._escape})
+        env.update(kwargs)
+        eval(self.co, env)
+        return env
+
+
+def run(name, source, kwargs, number):
+    old, new = LegacyTemplate(source), Template(source)
+    assert old.render(**kwargs) == new.render(**kwargs), name
+    before = timeit.timeit(lambda: old.render(**kwargs), number=number)
+    after = timeit.timeit(lambda: new.render(**kwargs), number=number)
+    print '%-6s old %8.1fus  new %8.1fus  x%.2f' % (name,
+            before / number * 1e6, after / number * 1e6, before / after)
+
+if __name__ == '__main__':
+    for name, source, kwargs in CASES:
+        run(name, source, kwargs, 2000)
@@ -0,0 +1,181 @@
+"""Minimal HTTP load generator, for benchmarking over loopback.
+
+    python benchmarks/loadgen.py HOST:PORT [-c CONNECTIONS] [-d SECONDS]
+            [-p PROCESSES] [--path PATH] [--close]
+
+Each connection sends a request, waits for the whole response and sends
+the next one, keep-alive unless `--close`. Responses must be delimited by
+Content-Length or by closing the connection. Connections are multiplexed
+with poll in each of `processes` processes, so the client isn't the
+bottleneck as soon.
+"""
+import os
+import sys
+import time
+import errno
+import select
+import socket
+import marshal
+import argparse
+
+
+class Connection(object):
+
+    def __init__(self, address, request, close):
+        self.address = address
+        self.request = request
+        self.close = close
+        self.sock = None
+
+    def connect(self):
+        self.sock = socket.create_connection(self.address)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setblocking(0)
+
+    def send(self):
+        self.buffer = ''
+        self.length = None
+        self.started = time.time()
+        self.sock.sendall(self.request)
+
+    def read(self):
+        """Read what's available, return `True` once the response is
+        complete."""
+        try:
+            data = self.sock.recv(65536)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+            raise
+        if not data:
+            if self.length is None and '\r\n\r\n' in self.buffer:
+                return True # delimited by the end of the connection
+            raise IOError('connection closed')
+        self.buffer += data
+        if self.length is None:
+            head, sep, body = self.buffer.partition('\r\n\r\n')
+            if not sep:
+                return False
+            for line in head.split('\r\n')[1:]:
+                name, _, value = line.partition(':')
+                if name.strip().lower() == 'content-length':
+                    self.length = len(head) + 4 + int(value)
+            if self.length is None:
+                return False
+        return len(self.buffer) >= self.length
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def generate(address, connections, duration, path='/', close=False):
+    """Run `connections` connections against `address` for `duration`
+    seconds, return `(latencies, errors)`."""
+    request = 'GET %s HTTP/1.1\r\nHost: %s:%d\r\n%s\r\n' % (path,
+            address[0], address[1], 'Connection: close\r\n' if close else '')
+    poller = select.poll()
+    conns = {}
+    for i in range(connections):
+        conn = Connection(address, request, close)
+        conn.connect()
+        conns[conn.sock.fileno()] = conn
+        poller.register(conn.sock.fileno(), select.POLLIN)
+        conn.send()
+    latencies = []
+    errors = 0
+    deadline = time.time() + duration
+    while conns and time.time() < deadline:
+        for fd, mask in poller.poll(1000):
+            conn = conns[fd]
+            try:
+                if not conn.read():
+                    continue
+            except (IOError, socket.error):
+                errors += 1
+            else:
+                latencies.append(time.time() - conn.started)
+                if not conn.close:
+                    conn.send()
+                    continue
+            # start over on a new connection
+            poller.unregister(fd)
+            del conns[fd]
+            conn.sock.close()
+            try:
+                conn.connect()
+                conn.send()
+            except socket.error:
+                errors += 1
+                continue
+            conns[conn.sock.fileno()] = conn
+            poller.register(conn.sock.fileno(), select.POLLIN)
+    for conn in conns.values():
+        conn.sock.close()
+    return latencies, errors
+
+def run(address, connections=16, duration=5, processes=1, path='/',
+        close=False):
+    """Spread `connections` over `processes` processes, return a dict with
+    requests per second, p50 and p99 latencies in milliseconds and the
+    number of errors."""
+    pipes = []
+    for i in range(processes):
+        share = connections // processes + (i < connections % processes)
+        read, write = os.pipe()
+        if os.fork() == 0:
+            os.close(read)
+            status = 0
+            try:
+                result = generate(address, share, duration, path, close)
+                with os.fdopen(write, 'wb') as f:
+                    f.write(marshal.dumps(result))
+            except BaseException:
+                status = 1
+            os._exit(status)
+        os.close(write)
+        pipes.append(read)
+    latencies = []
+    errors = 0
+    for read in pipes:
+        with os.fdopen(read, 'rb') as f:
+            data = f.read()
+        if data:
+            result = marshal.loads(data)
+            latencies.extend(result[0])
+            errors += result[1]
+        else:
+            errors += 1
+    for i in range(processes):
+        os.wait()
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'rps': len(latencies) / float(duration),
+        'p50_ms': percentile(latencies, .5) * 1e3 if latencies else None,
+        'p99_ms': percentile(latencies, .99) * 1e3 if latencies else None,
+        'errors': errors,
+    }
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='loadgen.py')
+    parser.add_argument('address', help='HOST:PORT')
+    parser.add_argument('-c', '--connections', type=int, default=16)
+    parser.add_argument('-d', '--duration', type=float, default=5)
+    parser.add_argument('-p', '--processes', type=int, default=1)
+    parser.add_argument('--path', default='/')
+    parser.add_argument('--close', action='store_true',
+            help='a new connection for every request')
+    args = parser.parse_args(argv)
+    host, _, port = args.address.rpartition(':')
+    result = run((host or '127.0.0.1', int(port)), args.connections,
+            args.duration, args.processes, args.path, args.close)
+    if not result['requests']:
+        print 'no response, %(errors)d errors' % result
+        return
+    print '%(requests)d requests, %(rps).0f req/s, p50 %(p50_ms).2fms, ' \
+            'p99 %(p99_ms).2fms, %(errors)d errors' % result
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
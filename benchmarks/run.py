@@ -0,0 +1,221 @@
+"""Run the benchmark suite and write the results as JSON.
+
+    python benchmarks/run.py [-o results.json] [--quick] [--only SUITE,...]
+            [--compare OLD.json]
+
+Suites:
+
+- servers: requests per second and p50/p99 latency of the async
+  `HTTPServer`, `WSGIServer` and `ThreadedWSGIServer` (thread per
+  connection and pooled), each in a child process, loaded over loopback by
+  `loadgen.py`;
+- app: `App` dispatch of a request, in process, for 10 to 1000 routes;
+- templates: `Template` translation and rendering;
+- utils: `unquote`, `quote` and `parse_params`.
+
+The output maps each benchmark to its metrics, along with the commit,
+Python version and platform, so runs can be compared across commits with
+`--compare`: times are in microseconds (lower is better), `rps` in
+requests per second (higher is better).
+"""
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import timeit
+import platform
+import argparse
+import subprocess
+import multiprocessing
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, os.pardir, 'src'))
+sys.path.insert(0, HERE)
+
+from trabant import utils
+from trabant.wsgiadaptor import App
+from trabant.template import Template
+import loadgen
+from bench_templates import CASES as TEMPLATES
+
+SUITES = ('servers', 'app', 'templates', 'utils')
+
+
+def timed(func, number, repeat=3):
+    """Best time of a call to `func` over `repeat` runs of `number` calls,
+    in microseconds."""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / \
+            number * 1e6
+
+
+def hello(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+        ('Content-Length', '13')])
+    return ['Hello, world!']
+
+def make_server(kind):
+    if kind == 'async':
+        from trabant.async_server import HTTPServer, EventLoop
+        server = HTTPServer(hello, '127.0.0.1', 0, loop=EventLoop(),
+                max_requests=10 ** 9)
+        return server, server.socket.getsockname()[1], server.run
+    from trabant.threaded_server import WSGIServer, ThreadedWSGIServer
+    if kind == 'wsgi':
+        server = WSGIServer(hello, '127.0.0.1', 0)
+    elif kind == 'threaded':
+        server = ThreadedWSGIServer(hello, '127.0.0.1', 0)
+    else:
+        server = ThreadedWSGIServer(hello, '127.0.0.1', 0, pool_size=16)
+    return server, server.server_address[1], server.run
+
+def serve(kind):
+    """Run a server of `kind` in a child process, return its pid and
+    port."""
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid:
+        os.close(write)
+        port = int(os.read(read, 16))
+        os.close(read)
+        return pid, port
+    os.close(read)
+    # clients hanging up at the end of a run are no news
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    status = 0
+    try:
+        server, port, run = make_server(kind)
+        os.write(write, str(port))
+        run()
+    except BaseException:
+        status = 1
+    os._exit(status)
+
+def bench_servers(quick):
+    duration = 1 if quick else 5
+    results = {}
+    # the single threaded WSGIServer serves a connection at a time
+    for kind, connections in [('async', 1), ('async', 16), ('async', 64),
+            ('wsgi', 1), ('threaded', 1), ('threaded', 16),
+            ('pool', 16)]:
+        pid, port = serve(kind)
+        try:
+            result = loadgen.run(('127.0.0.1', port), connections, duration)
+        finally:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        results['servers.%s.c%d' % (kind, connections)] = result
+    return results
+
+def bench_app(quick):
+    number = 2000 if quick else 20000
+    results = {}
+    for n in (10, 100, 1000):
+        routes = [('^/r%d/(?P<id>\d+)$' % i,
+            lambda environ, id: 'ok') for i in range(n)]
+        app = App(routes)
+        for label, path in (('first', '/r0/1'), ('last', '/r%d/1' % (n - 1)),
+                ('miss', '/missing')):
+            environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path,
+                    'QUERY_STRING': ''}
+            results['app.routes%d.%s' % (n, label)] = {'us': timed(
+                lambda: app(environ.copy(), lambda status, headers: None),
+                number // 10 if n == 1000 else number)}
+    return results
+
+def bench_templates(quick):
+    number = 200 if quick else 2000
+    results = {}
+    for name, source, kwargs in TEMPLATES:
+        results['templates.%s.translate' % name] = {'us': timed(
+            lambda: Template(source), number // 10)}
+        template = Template(source)
+        results['templates.%s.render' % name] = {'us': timed(
+            lambda: template.render(**kwargs), number)}
+    return results
+
+def bench_utils(quick):
+    number = 10000 if quick else 100000
+    return {
+        'utils.unquote': {'us': timed(lambda:
+            utils.unquote('/caf%C3%A9/some%20path/x%2Fy'), number)},
+        'utils.quote': {'us': timed(lambda:
+            utils.quote('/caf\xc3\xa9/some path/x&y'), number)},
+        'utils.parse_params': {'us': timed(lambda:
+            utils.parse_params('q=trabant+server&page=2&sort=&debug&'
+                'name=caf%C3%A9'), number)},
+    }
+
+
+def metadata(quick):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                cwd=HERE, stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'cpus': multiprocessing.cpu_count(),
+        'quick': quick,
+    }
+
+def format_metrics(metrics):
+    if 'rps' in metrics:
+        if not metrics['requests']:
+            return 'no responses, %(errors)d errors' % metrics
+        return '%(rps)9.0f req/s  p50 %(p50_ms)7.2fms  p99 %(p99_ms)7.2fms' \
+                '  %(errors)d errors' % metrics
+    return '%9.2fus' % metrics['us']
+
+def compare(old, new):
+    for name in sorted(new):
+        if name not in old:
+            continue
+        for metric in ('us', 'rps'):
+            before, after = old[name].get(metric), new[name].get(metric)
+            if before and after:
+                # > 1 is better
+                ratio = before / after if metric == 'us' else after / before
+                print '%-32s %-4s %12.2f %12.2f  x%.2f' % (name, metric,
+                        before, after, ratio)
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='run.py')
+    parser.add_argument('-o', '--output', default='bench_results.json')
+    parser.add_argument('--quick', action='store_true',
+            help='shorter runs, for a rough idea')
+    parser.add_argument('--only', help='comma separated suites, among %s' %
+            ', '.join(SUITES))
+    parser.add_argument('--compare', metavar='FILE',
+            help='results of an earlier run to compare with')
+    args = parser.parse_args(argv)
+    suites = args.only.split(',') if args.only else SUITES
+    for suite in suites:
+        if suite not in SUITES:
+            parser.error('unknown suite %r' % suite)
+
+    results = {}
+    for suite in suites:
+        suite_results = globals()['bench_' + suite](args.quick)
+        for name in sorted(suite_results):
+            print '%-32s %s' % (name, format_metrics(suite_results[name]))
+        results.update(suite_results)
+    with open(args.output, 'w') as f:
+        json.dump({'meta': metadata(args.quick), 'results': results}, f,
+                indent=2, sort_keys=True)
+    print 'results written to %s' % args.output
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)['results']
+        print
+        compare(old, results)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
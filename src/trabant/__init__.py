@@ -1,4 +1,5 @@
 from threaded_server import WSGIServer, ThreadedWSGIServer
-from wsgiadaptor import App, HTTPError, serve_static, redirect
+from wsgiadaptor import App, Request, HTTPError, serve_static, redirect
 from template import Template, Renderer
 
+from async_server import HTTPServer, loop
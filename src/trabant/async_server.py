@@ -1,168 +1,1171 @@
+"""Single threaded, event driven HTTP server.
+
+Sockets are multiplexed by an `EventLoop` over the best poller the platform
+has: epoll on Linux, then poll, then select. Besides plain WSGI apps it
+runs coroutine handlers: a response iterable that's a generator can yield
+a `Future` (see `sleep` and `run_in_thread`) to wait for it without
+blocking the loop, the result is sent back into the generator.
+
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        rows = yield run_in_thread(query, environ['QUERY_STRING'])
+        yield '\\n'.join(rows)
+
+    server = HTTPServer(app, 'localhost', 8080)
+    loop()
+"""
+
+import os
+import sys
+import time
+import heapq
+import errno
+import fcntl
+import select
 import socket
-import asyncore
-import asynchat
+import itertools
+import threading
+import traceback
 
 from StringIO import StringIO
+from tempfile import SpooledTemporaryFile
 from datetime import datetime
+from collections import deque
 
-from trabant import utils
+from trabant.utils import httpdate
+from trabant.filewrapper import FileWrapper, sendfile, BLOCK_SIZE
+from trabant.httpparser import RequestParser, ParseError
 
 SERVER = 'Trabant 0.0.1'
 
-def httpdate(dt):
-    """Return a string representation of a date according to RFC 1123
-    (HTTP/1.1).
+# at most this many buffers are handed to a single sendmsg call
+MAX_IOV = 64
+# without sendmsg, strings shorter than this are joined before sending
+COALESCE = 16 * 1024
+# bytes read from a socket at once
+READ_SIZE = 64 * 1024
+# seconds to wait before accepting again when out of file descriptors
+ACCEPT_RETRY = 0.1
+
+try:
+    sendmsg = socket.socket.sendmsg
+except AttributeError:
+    sendmsg = None
+
+EVENT_READ = 1
+EVENT_WRITE = 2
+
+_WOULDBLOCK = frozenset((errno.EAGAIN, errno.EWOULDBLOCK))
+_DISCONNECTED = frozenset((errno.ECONNRESET, errno.ENOTCONN,
+    errno.ESHUTDOWN, errno.ECONNABORTED, errno.EPIPE, errno.EBADF))
+# accept errors that leave the connection waiting in the backlog
+_EXHAUSTED = frozenset((errno.EMFILE, errno.ENFILE, errno.ENOBUFS,
+    errno.ENOMEM))
+
+
+class EpollPoller(object):
+
+    def __init__(self):
+        self.epoll = select.epoll()
+
+    def _mask(self, events):
+        mask = 0
+        if events & EVENT_READ:
+            mask |= select.EPOLLIN
+        if events & EVENT_WRITE:
+            mask |= select.EPOLLOUT
+        return mask
+
+    def register(self, fd, events):
+        self.epoll.register(fd, self._mask(events))
+
+    def modify(self, fd, events):
+        self.epoll.modify(fd, self._mask(events))
+
+    def unregister(self, fd):
+        self.epoll.unregister(fd)
+
+    def poll(self, timeout):
+        ready = []
+        for fd, mask in self.epoll.poll(timeout, 1024):
+            events = 0
+            # errors and hang ups are reported to both sides, the handler
+            # finds out what happened when reading or writing
+            if mask & (select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP):
+                events |= EVENT_READ
+            if mask & (select.EPOLLOUT | select.EPOLLERR | select.EPOLLHUP):
+                events |= EVENT_WRITE
+            ready.append((fd, events))
+        return ready
+
+
+class PollPoller(object):
+
+    def __init__(self):
+        self.poller = select.poll()
+
+    def _mask(self, events):
+        mask = 0
+        if events & EVENT_READ:
+            mask |= select.POLLIN
+        if events & EVENT_WRITE:
+            mask |= select.POLLOUT
+        return mask
+
+    def register(self, fd, events):
+        self.poller.register(fd, self._mask(events))
+
+    modify = register
+
+    def unregister(self, fd):
+        self.poller.unregister(fd)
+
+    def poll(self, timeout):
+        ready = []
+        for fd, mask in self.poller.poll(timeout * 1000):
+            events = 0
+            if mask & (select.POLLIN | select.POLLERR | select.POLLHUP |
+                    select.POLLNVAL):
+                events |= EVENT_READ
+            if mask & (select.POLLOUT | select.POLLERR | select.POLLHUP):
+                events |= EVENT_WRITE
+            ready.append((fd, events))
+        return ready
+
+
+class SelectPoller(object):
+
+    def __init__(self):
+        self.readers = set()
+        self.writers = set()
+
+    def register(self, fd, events):
+        self.unregister(fd)
+        if events & EVENT_READ:
+            self.readers.add(fd)
+        if events & EVENT_WRITE:
+            self.writers.add(fd)
+
+    modify = register
+
+    def unregister(self, fd):
+        self.readers.discard(fd)
+        self.writers.discard(fd)
+
+    def poll(self, timeout):
+        if not self.readers and not self.writers:
+            time.sleep(timeout)
+            return []
+        r, w, x = select.select(self.readers, self.writers, [], timeout)
+        ready = dict((fd, EVENT_READ) for fd in r)
+        for fd in w:
+            ready[fd] = ready.get(fd, 0) | EVENT_WRITE
+        return ready.items()
+
+
+def best_poller():
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    if hasattr(select, 'poll'):
+        return PollPoller()
+    return SelectPoller()
+
+
+class Future(object):
+    """The result of an operation that completes later. Coroutine handlers
+    yield it to wait for the result."""
+
+    def __init__(self):
+        self.done = False
+        self.result = None
+        self.exception = None
+        self.callbacks = []
+
+    def set_result(self, result):
+        self.result = result
+        self._finish()
 
-    The supplied date must be in UTC.
+    def set_exception(self, exception):
+        self.exception = exception
+        self._finish()
 
+    def _finish(self):
+        self.done = True
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        if self.done:
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+
+class TimerWheel(object):
+    """Deadlines for many objects, cheap to set and to move: objects are
+    filed in one of `slots` buckets, each covering `resolution` seconds,
+    and only the buckets that came due are looked at as time goes by.
+
+    Pushing a deadline later (what every bit of I/O on a connection does)
+    just records it, the object is filed again when its old bucket comes
+    up. Deadlines fire up to `resolution` seconds late.
     """
-    weekday = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'][dt.weekday()]
-    month = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep',
-             'Oct', 'Nov', 'Dec'][dt.month - 1]
-    return '%s, %02d %s %04d %02d:%02d:%02d GMT' % (weekday, dt.day, month,
-        dt.year, dt.hour, dt.minute, dt.second)
 
-class RequestHandler(asynchat.async_chat):
+    def __init__(self, resolution=0.5, slots=512):
+        self.resolution = resolution
+        self.slots = [set() for i in xrange(slots)]
+        self.tick = int(time.time() / resolution)
+        self.deadlines = {} # object -> deadline
+        self.ticks = {} # object -> tick of the bucket it's in
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def schedule(self, obj, deadline):
+        """Set the deadline of `obj`, `None` to cancel it."""
+        tick = self.ticks.get(obj)
+        if deadline is None:
+            if tick is not None:
+                self.slots[tick % len(self.slots)].discard(obj)
+                del self.ticks[obj], self.deadlines[obj]
+            return
+        self.deadlines[obj] = deadline
+        due = max(int(deadline / self.resolution) + 1, self.tick + 1)
+        if tick is not None:
+            if tick <= due:
+                return
+            self.slots[tick % len(self.slots)].discard(obj)
+        self.slots[due % len(self.slots)].add(obj)
+        self.ticks[obj] = due
+
+    def expire(self, now):
+        """Remove and return the objects whose deadline has passed."""
+        tick = int(now / self.resolution)
+        size = len(self.slots)
+        expired = []
+        start = max(self.tick + 1, tick - size + 1)
+        self.tick = tick
+        for t in xrange(start, tick + 1):
+            slot = self.slots[t % size]
+            if not slot:
+                continue
+            self.slots[t % size] = set()
+            for obj in slot:
+                deadline = self.deadlines[obj]
+                if deadline <= now:
+                    del self.ticks[obj], self.deadlines[obj]
+                    expired.append(obj)
+                else:
+                    # moved later since it was filed
+                    due = max(int(deadline / self.resolution) + 1, tick + 1)
+                    self.slots[due % size].add(obj)
+                    self.ticks[obj] = due
+        return expired
+
+
+class EventLoop(object):
+    """Dispatch socket events to handlers, which implement `handle_read`,
+    `handle_write`, `handle_error` and `update_events`, and run callbacks
+    and timers. Handlers given a deadline in `wheel` have their
+    `handle_timeout` called once it's passed."""
+
+    def __init__(self, poller=None):
+        self.poller = poller or best_poller()
+        self.pid = os.getpid()
+        self.handlers = {} # fd -> handler
+        self.events = {} # fd -> registered events
+        self.callbacks = deque()
+        self.timers = [] # heap of (deadline, seq, callback, args)
+        self.seq = itertools.count()
+        self.wheel = TimerWheel()
+        self.waker = None
+
+    def register(self, fd, handler, events):
+        if self.pid != os.getpid():
+            self.after_fork()
+        self.handlers[fd] = handler
+        self.events[fd] = events
+        self.poller.register(fd, events)
+
+    def after_fork(self):
+        """Start afresh in a forked process: an epoll instance is shared
+        with the parent, and so are its registrations."""
+        self.poller = type(self.poller)()
+        self.pid = os.getpid()
+        self.handlers.clear()
+        self.events.clear()
+        self.callbacks.clear()
+        del self.timers[:]
+        self.wheel = TimerWheel()
+        self.waker = None
+
+    def set_events(self, fd, events):
+        if self.events.get(fd, events) != events:
+            self.events[fd] = events
+            self.poller.modify(fd, events)
+
+    def unregister(self, fd):
+        if self.handlers.pop(fd, None) is not None:
+            del self.events[fd]
+            self.poller.unregister(fd)
+
+    def call_soon(self, callback, *args):
+        self.callbacks.append((callback, args))
+
+    def add_waker(self):
+        """Get ready for `call_soon_threadsafe`, from the loop's thread."""
+        if self.waker is None:
+            self.waker = _Waker(self)
+
+    def call_soon_threadsafe(self, callback, *args):
+        """Like `call_soon`, from any thread, once `add_waker` is done."""
+        self.callbacks.append((callback, args))
+        self.waker.wake()
+
+    def call_later(self, delay, callback, *args):
+        heapq.heappush(self.timers, (time.time() + delay, next(self.seq),
+            callback, args))
+
+    def run_once(self, timeout):
+        if self.callbacks:
+            timeout = 0
+        else:
+            if self.wheel:
+                timeout = min(timeout, self.wheel.resolution)
+            if self.timers:
+                timeout = max(0, min(timeout,
+                    self.timers[0][0] - time.time()))
+        try:
+            ready = self.poller.poll(timeout)
+        except (select.error, IOError, OSError), e:
+            if e.args[0] != errno.EINTR:
+                raise
+            ready = []
+
+        handlers = self.handlers
+        for fd, events in ready:
+            handler = handlers.get(fd)
+            if handler is None:
+                continue
+            try:
+                if events & EVENT_READ:
+                    handler.handle_read()
+                if events & EVENT_WRITE and handlers.get(fd) is handler:
+                    handler.handle_write()
+            except Exception:
+                handler.handle_error()
+            if handlers.get(fd) is handler:
+                handler.update_events()
+
+        now = time.time()
+        for handler in self.wheel.expire(now):
+            try:
+                handler.handle_timeout()
+            except Exception:
+                handler.handle_error()
+        while self.timers and self.timers[0][0] <= now:
+            deadline, seq, callback, args = heapq.heappop(self.timers)
+            self.callbacks.append((callback, args))
+        for i in range(len(self.callbacks)):
+            callback, args = self.callbacks.popleft()
+            try:
+                callback(*args)
+            except Exception:
+                traceback.print_exc()
+
+    def alive(self):
+        """Whether there's anything but the waker to wait for."""
+        return len(self.handlers) > (self.waker is not None)
+
+
+class _Waker(object):
+    """Pipe that wakes the loop up from other threads."""
+
+    def __init__(self, loop):
+        self.rfd, self.wfd = os.pipe()
+        for fd in (self.rfd, self.wfd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        loop.register(self.rfd, self, EVENT_READ)
+
+    def wake(self):
+        try:
+            os.write(self.wfd, 'x')
+        except OSError:
+            pass # the pipe is full, the loop wakes up anyway
+
+    def handle_read(self):
+        try:
+            os.read(self.rfd, 4096)
+        except OSError:
+            pass
+
+    def handle_write(self):
+        pass
+
+    def handle_error(self):
+        traceback.print_exc()
+
+    def update_events(self):
+        pass
+
+event_loop = EventLoop()
+
+def sleep(delay, loop=None):
+    """Return a `Future` resolved after `delay` seconds."""
+    future = Future()
+    (loop or event_loop).call_later(delay, future.set_result, None)
+    return future
+
+def run_in_thread(func, *args, **kwargs):
+    """Run a blocking `func` in a new thread, return a `Future` for its
+    result, resolved in the loop passed as `loop` (the default one)."""
+    loop = kwargs.pop('loop', None) or event_loop
+    loop.add_waker()
+    future = Future()
+    def run():
+        try:
+            result = func(*args, **kwargs)
+        except Exception, e:
+            loop.call_soon_threadsafe(future.set_exception, e)
+        else:
+            loop.call_soon_threadsafe(future.set_result, result)
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return future
+
+
+class RequestHandler(object):
     READING_HEADERS = 0
     READING_BODY_DATA = 1
     HANDLING = 2
     FINISHED = 3
 
     def __init__(self, sock, addr, server):
-        asynchat.async_chat.__init__(self, sock)
+        sock.setblocking(0)
+        self.socket = sock
+        self.fd = sock.fileno()
         self.addr = addr
-        self.server = server 
-        self.ibuffer = StringIO()
-        self.obuffer = ''
-        self.set_terminator('\r\n\r\n')
-        self.state = RequestHandler.READING_HEADERS
-        self.cgi_data = None
+        self.server = server
+        self.loop = server.loop
+        self.pending = '' # pipelined input, waiting for the response
+        self.outgoing = deque() # strings, files and bodies to send
+        self.ooffset = 0 # bytes of outgoing[0] already sent
+        self.requests = 0
+        self.last_activity = time.time()
+        self.head_started = self.last_activity
+        self.trace = None
+        self.closed = False
+        self.read_request()
+        self.loop.register(self.fd, self, EVENT_READ)
+        self.loop.wheel.schedule(self, self.deadline(EVENT_READ))
 
     def _prepare_environ(self):
         environ = self.server.environ.copy()
-        headers = {}
-        args = {}
-        self.ibuffer.seek(0)
-        lines = filter(bool, self.ibuffer.readlines())
-        method, url, protocol = lines.pop(0).split()
-        path, query = utils.splitquery(url)
-
-        environ['REQUEST_METHOD'] = method.upper()
-        environ['SCRIPT_NAME'] = ''
-        environ['PATH_INFO'] = path
-        environ['QUERY_STRING'] = query
-        environ['SERVER_PROTOCOL'] = protocol
-
-        for line in lines:
-            k, v = map(str.strip, line.split(':', 1))
-            header = '_'.join(k.split('-')).upper()
-            if header not in ('CONTENT_LENGTH', 'CONTENT_TYPE'):
-                header = 'HTTP_%s' % header
-            environ[header] = v
-        self.ibuffer.seek(0, 2)
+        environ.update(self.parser.environ)
         return environ
 
+    def read_request(self):
+        """Get ready to read the next request head."""
+        self.parser = RequestParser(**self.server.parser_limits)
+        self.state = RequestHandler.READING_HEADERS
 
-    def collect_incoming_data(self, data):
-        """Buffer the data"""
-        if self.state == RequestHandler.READING_BODY_DATA:
-            self.environ['wsgi.input'].write(data)
-        else:
-            self.ibuffer.write(data)
+    def process(self, data):
+        """Feed `data` to the request being read, handling every request
+        it completes."""
+        while data:
+            if self.state == RequestHandler.READING_HEADERS:
+                if not self.parser.started():
+                    self.head_started = self.last_activity
+                try:
+                    data = self.parser.feed(data)
+                except ParseError, e:
+                    self.server.rejected += 1
+                    self.reject(e.status_code, e)
+                    return
+                if self.parser.complete:
+                    data = self.start_request(data)
+            elif self.state == RequestHandler.READING_BODY_DATA:
+                data = self.read_body(data)
+            else:
+                self.pending += data
+                return
 
-    def found_terminator(self):
-        if self.state == RequestHandler.READING_HEADERS:
-            self.environ = self._prepare_environ()
-            if self.environ['REQUEST_METHOD'] == 'POST':
-                self.state = RequestHandler.READING_BODY_DATA
-                length = self.environ['CONTENT_LENGTH']
-                expect = self.environ.get('HTTP_EXPECT')
-                self.environ['wsgi.input'] = StringIO()
-                if not expect:
-                    self.obuffer.append('')
-                    self.status = RequestHandler.FINISHED
-                else:
-                    self.obuffer = 'HTTP/1.1 100 Continue\r\n\r\n'
+    def start_request(self, data):
+        self.environ = self._prepare_environ()
+        tracer = self.server.tracer
+        if tracer is not None:
+            if self.trace is not None:
+                # pipelined, the previous response is still being written
+                self.finish_trace()
+            self.trace = tracer.begin(self.environ, self.head_started)
+        length = int(self.environ.get('CONTENT_LENGTH') or 0)
+        if not length:
+            self.environ['wsgi.input'] = StringIO()
+            self.state = RequestHandler.HANDLING
+            self.handle_request()
+            return data
+        # kept in memory up to spool_size, then moved to disk
+        self.environ['wsgi.input'] = SpooledTemporaryFile(
+                self.server.spool_size)
+        self.remaining = length
+        self.state = RequestHandler.READING_BODY_DATA
+        expect = self.environ.get('HTTP_EXPECT', '')
+        if expect.lower() == '100-continue' and not data:
+            self.queue_output('HTTP/1.1 100 Continue\r\n\r\n')
+        return data
 
-                self.set_terminator(int(length))
-            else:
-                self.state = RequestHandler.HANDLING
-                self.set_terminator(None)
-                self.handle_request()
-        elif self.state == RequestHandler.READING_BODY_DATA:
-            self.set_terminator(None) # browsers sometimes over-send
+    def read_body(self, data):
+        if len(data) > self.remaining:
+            data, rest = data[:self.remaining], data[self.remaining:]
+        else:
+            rest = ''
+        self.environ['wsgi.input'].write(data)
+        self.remaining -= len(data)
+        if not self.remaining:
             self.environ['wsgi.input'].seek(0)
+            if self.trace is not None:
+                self.trace.mark('body')
+            self.state = RequestHandler.HANDLING
             self.handle_request()
+        return rest
+
+    def reject(self, status_code, message):
+        """Answer an invalid request with `status_code` and close."""
+        status = '%d %s' % (status_code, message)
+        self.queue_output('HTTP/1.1 %s\r\nContent-Type: text/plain\r\n'
+                'Content-Length: %d\r\nConnection: close\r\n\r\n%s' % (
+                    status, len(status), status))
+        self.state = RequestHandler.FINISHED
 
     def readable(self):
-        return self.state != RequestHandler.FINISHED
+        return self.state in (RequestHandler.READING_HEADERS,
+                RequestHandler.READING_BODY_DATA)
 
     def writable(self):
-        return (len(self.obuffer) > 0)
+        if not self.outgoing:
+            return False
+        # not while the body at the head of the queue waits for a future
+        head = self.outgoing[0]
+        return not (isinstance(head, _Body) and head.waiting)
+
+    def update_events(self):
+        events = 0
+        if self.readable():
+            events |= EVENT_READ
+        if self.writable():
+            events |= EVENT_WRITE
+        self.loop.set_events(self.fd, events)
+        self.loop.wheel.schedule(self, self.deadline(events))
+
+    def deadline(self, events):
+        """When the connection times out in its current phase, if ever:
+        sending the response, receiving the head of a request or its body,
+        or waiting for the next request. No limit while the app works."""
+        server = self.server
+        if events & EVENT_WRITE:
+            return self.last_activity + server.write_timeout
+        if self.outgoing:
+            return None
+        if self.state == RequestHandler.READING_HEADERS:
+            if self.parser.started():
+                return self.head_started + server.header_timeout
+            return self.last_activity + server.keep_alive_timeout
+        if self.state == RequestHandler.READING_BODY_DATA:
+            return self.last_activity + server.body_timeout
+        return None
+
+    def handle_timeout(self):
+        """A request being received is answered with a 408, otherwise the
+        connection is closed."""
+        self.server.timeouts += 1
+        if not self.outgoing and (
+                self.state == RequestHandler.READING_BODY_DATA or
+                self.state == RequestHandler.READING_HEADERS and
+                self.parser.started()):
+            self.reject(408, 'Request Timeout')
+            self.update_events()
+        else:
+            self.handle_close()
+
+    def keep_alive(self):
+        """HTTP/1.1 connections are persistent unless the client asks to
+        close them, HTTP/1.0 ones only if the client asks to keep them."""
+        if self.requests >= self.server.max_requests or self.server.stopping:
+            return False
+        connection = self.environ.get('HTTP_CONNECTION', '').lower()
+        tokens = [token.strip() for token in connection.split(',')]
+        if self.environ['SERVER_PROTOCOL'] == 'HTTP/1.1':
+            return 'close' not in tokens
+        return 'keep-alive' in tokens
 
     def handle_request(self):
-        buffer = []
+        response = self.response = []
         def start_response(status, response_headers, exc_info=None):
-            status_code = status[:3]
-            buffer.append(' '.join((self.environ['SERVER_PROTOCOL'], status)))
-            buffer.extend([': '.join(h) for h in response_headers])
+            if exc_info:
+                try:
+                    if self.response is not response:
+                        # the head is already out
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                finally:
+                    exc_info = None
+            response[:] = [status, response_headers]
+
+        self.requests += 1
+        self.server.request_done()
+        tracer = self.server.tracer
+        if tracer is None:
+            result = self.server.wsgiapp(self.environ, start_response)
+        else:
+            result = tracer.call(self.server.wsgiapp, self.environ,
+                    start_response)
+        if not response or not isinstance(result, (list, tuple)) and not (
+                isinstance(result, FileWrapper) and result.length is not None):
+            # consumed lazily as the socket becomes writable, the head goes
+            # out with the first chunk: a generator calls start_response
+            # when it's first resumed
+            self.queue_output(_Body(result))
+            return
 
-        result = self.server.wsgiapp(self.environ, start_response)
+        status, headers = response
+        length = None
+        body = []
+        if status[:3] in ('204', '304'):
+            if hasattr(result, 'close'):
+                result.close()
+        elif isinstance(result, FileWrapper):
+            body = [[result, result.filelike.tell(), result.length]]
+            length = result.length
+        else:
+            body = [_encode(data) for data in result if data]
+            length = sum(map(len, body))
+            if hasattr(result, 'close'):
+                result.close()
+        if self.environ['REQUEST_METHOD'] == 'HEAD' and body:
+            # the length the GET would get, but no body
+            if isinstance(result, FileWrapper) and hasattr(result, 'close'):
+                result.close()
+            body = []
+        keep_alive = self.keep_alive()
+        self.queue_output(self.response_head(length, False, keep_alive))
+        self.outgoing.extend(body)
+        self.finish_request(keep_alive)
 
-        body = ''.join(result)
+    def response_head(self, length, chunked, keep_alive):
+        """Build the response head from what the app passed to
+        `start_response`, with `length` as its Content-Length."""
+        status, headers = self.response
+        self.response = None
+        buffer = [' '.join((self.environ['SERVER_PROTOCOL'], status))]
+        for name, value in headers:
+            if name.lower() != 'content-length':
+                buffer.append('%s: %s' % (name, value))
         buffer.extend([
             'Date: %s' % httpdate(datetime.utcnow()),
             'Server: %s' % SERVER,
-            #'Accept-Ranges: none',
-            'Connection: close',
+            'Connection: %s' % (keep_alive and 'keep-alive' or 'close'),
         ])
+        if chunked:
+            buffer.append('Transfer-Encoding: chunked')
+        elif length is not None:
+            buffer.append('Content-Length: %d' % length)
+        buffer.extend(['', ''])
+        return _encode('\r\n'.join(buffer))
 
-        if body:
-            buffer.extend(['Content-Length: %d' % len(body), '', body])
+    def start_body(self, body, ended):
+        """Decide how the lazy `body` is delimited, once the app has called
+        `start_response`, and return the response head."""
+        if not self.response:
+            raise RuntimeError('start_response was not called')
+        status, headers = self.response
+        keep_alive = self.keep_alive()
+        length = None
+        declared = [value for name, value in headers
+                if name.lower() == 'content-length']
+        if status[:3] in ('204', '304'):
+            body.discard = True
+        elif self.environ['REQUEST_METHOD'] == 'HEAD':
+            body.discard = True
+            if declared:
+                length = int(declared[0])
+        elif declared:
+            length = int(declared[0])
+        elif ended:
+            length = 0
+        elif self.environ['SERVER_PROTOCOL'] == 'HTTP/1.1':
+            body.chunked = True
+        else:
+            keep_alive = False
+        body.keep_alive = keep_alive
+        body.started = True
+        return self.response_head(length, body.chunked, keep_alive)
 
-        self.obuffer = '\r\n'.join(buffer)
-        self.state = RequestHandler.FINISHED
+    def finish_request(self, keep_alive):
+        if keep_alive:
+            # get ready for the next request, pipelined input is processed
+            # from the loop
+            self.read_request()
+            if self.pending:
+                self.loop.call_soon(self.process_pending)
+        else:
+            self.state = RequestHandler.FINISHED
+
+    def finish_trace(self):
+        trace, self.trace = self.trace, None
+        self.server.tracer.finish(trace)
+
+    def process_pending(self):
+        if self.closed:
+            return
+        data, self.pending = self.pending, ''
+        try:
+            self.process(data)
+        except Exception:
+            self.handle_error()
+            return
+        self.update_events()
+
+    def resume(self, future):
+        if not self.closed:
+            self.outgoing[0].waiting = False
+            # the write timeout starts now, not when the app started waiting
+            self.last_activity = time.time()
+            self.update_events()
+
+    def idle(self):
+        """Whether the connection is waiting for a new request."""
+        return self.state == RequestHandler.READING_HEADERS and \
+                not self.outgoing and not self.parser.started()
+
+    def phase(self):
+        """What the connection is doing, for metrics: `idle`, `reading`
+        a request, `handling` it or `writing` the response."""
+        if self.writable():
+            return 'writing'
+        if self.outgoing or self.state == RequestHandler.HANDLING:
+            return 'handling'
+        if self.idle():
+            return 'idle'
+        return 'reading'
+
+    def handle_read(self):
+        self.last_activity = time.time()
+        try:
+            data = self.socket.recv(READ_SIZE)
+        except socket.error, why:
+            if why.args[0] in _WOULDBLOCK:
+                return
+            if why.args[0] in _DISCONNECTED:
+                self.handle_close()
+                return
+            raise
+        if not data:
+            self.handle_close()
+            return
+        self.process(data)
 
-    def handle_expt(self):
-        print 'exception!'
-        self.close()
+    def queue_output(self, item):
+        """Queue a string, a `[file_wrapper, offset, count]` list or a lazy
+        `_Body`, to be sent after what is already queued."""
+        if not self.outgoing:
+            # the write timeout starts now, however long the app took
+            self.last_activity = time.time()
+        self.outgoing.append(item)
+
+    def prepare_head(self):
+        """Turn the head of the output queue into strings, pulling the next
+        chunk from a body iterator or reading the next one from a file that
+        can't be sent with `sendfile`. Returns `False` if there's nothing to
+        send as a string."""
+        outgoing = self.outgoing
+        while outgoing:
+            head = outgoing[0]
+            if isinstance(head, str):
+                if head:
+                    return True
+                outgoing.popleft()
+                continue
+            if isinstance(head, _Body):
+                if head.waiting:
+                    return False
+                try:
+                    data = head.next()
+                except StopIteration:
+                    outgoing.popleft()
+                    head.close()
+                    parts = []
+                    if not head.started:
+                        parts.append(self.start_body(head, True))
+                    if head.chunked:
+                        parts.append('0\r\n\r\n')
+                    outgoing.extendleft(reversed(parts))
+                    self.finish_request(head.keep_alive)
+                    continue
+                if isinstance(data, Future):
+                    head.future = data
+                    if not data.done:
+                        head.waiting = True
+                        data.add_done_callback(self.resume)
+                    continue
+                parts = []
+                if not head.started:
+                    parts.append(self.start_body(head, False))
+                data = _encode(data)
+                if data and not head.discard:
+                    if head.chunked:
+                        parts.extend(['%x\r\n' % len(data), data, '\r\n'])
+                    else:
+                        parts.append(data)
+                outgoing.extendleft(reversed(parts))
+            elif sendfile is not None and len(head) == 3:
+                return False
+            else:
+                wrapper, offset, count = head[:3]
+                wrapper.filelike.seek(offset)
+                data = wrapper.filelike.read(min(count, BLOCK_SIZE))
+                head[1] += len(data)
+                head[2] -= len(data)
+                if not data or not head[2]:
+                    outgoing.popleft()
+                    if hasattr(wrapper, 'close'):
+                        wrapper.close()
+                if data:
+                    outgoing.appendleft(data)
+        return False
+
+    def send_file_chunk(self, entry):
+        """Send the next chunk of the file at the head of the queue with
+        `sendfile`. Returns `True` once the whole file is out."""
+        wrapper, offset, count = entry
+        try:
+            sent = sendfile(self.fd, wrapper.fileno(),
+                    wrapper.file_offset + offset, min(count, BLOCK_SIZE))
+        except (AttributeError, ValueError):
+            entry.append(False) # not a real file, copy it
+            return False
+        except OSError, e:
+            if e.errno in _WOULDBLOCK:
+                return False
+            if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                raise
+            entry.append(False) # not sendfile-able, copy from now on
+            return False
+        entry[1] += sent
+        entry[2] -= sent
+        if sent and entry[2] > 0:
+            return False
+        if hasattr(wrapper, 'close'):
+            wrapper.close()
+        return True
+
+    def send(self, data):
+        try:
+            return self.socket.send(data)
+        except socket.error, why:
+            if why.args[0] in _WOULDBLOCK:
+                return 0
+            if why.args[0] in _DISCONNECTED:
+                self.handle_close()
+                return 0
+            raise
+
+    def send_buffers(self):
+        """Send as many of the strings at the head of the queue as the
+        socket takes, in a single `sendmsg` (writev) call where available.
+        Partial sends are tracked with `ooffset`, nothing is sliced."""
+        outgoing = self.outgoing
+        if sendmsg is not None:
+            buffers = [memoryview(outgoing[0])[self.ooffset:]]
+            for item in itertools.islice(outgoing, 1, MAX_IOV):
+                if not isinstance(item, str):
+                    break
+                buffers.append(item)
+            try:
+                sent = sendmsg(self.socket, buffers)
+            except socket.error, why:
+                if why.args[0] in _WOULDBLOCK:
+                    return
+                if why.args[0] in _DISCONNECTED:
+                    self.handle_close()
+                    return
+                raise
+        else:
+            head = outgoing[0]
+            if len(head) - self.ooffset < COALESCE and len(outgoing) > 1 and \
+                    isinstance(outgoing[1], str):
+                # coalesce small strings (headers, chunk framing) in a send
+                parts = [head[self.ooffset:]]
+                size = len(parts[0])
+                outgoing.popleft()
+                while outgoing and isinstance(outgoing[0], str) and \
+                        size < COALESCE:
+                    parts.append(outgoing.popleft())
+                    size += len(parts[-1])
+                head = ''.join(parts)
+                outgoing.appendleft(head)
+                self.ooffset = 0
+            sent = self.send(buffer(head, self.ooffset))
+
+        while sent:
+            remaining = len(outgoing[0]) - self.ooffset
+            if sent < remaining:
+                self.ooffset += sent
+                break
+            outgoing.popleft()
+            self.ooffset = 0
+            sent -= remaining
 
     def handle_write(self):
-        sent = self.send(self.obuffer)
-        self.obuffer = self.obuffer[sent:]
-        if not self.obuffer and self.state == RequestHandler.FINISHED:
-            self.close()
+        self.last_activity = time.time()
+        try:
+            if self.prepare_head():
+                self.send_buffers()
+            elif self.writable() and self.send_file_chunk(self.outgoing[0]):
+                self.outgoing.popleft()
+        except Exception:
+            # the response can't be completed, the client will notice
+            self.handle_error()
+            return
+        if self.outgoing:
+            return
+        if self.trace is not None and \
+                self.state != RequestHandler.READING_BODY_DATA:
+            self.finish_trace()
+        if self.state == RequestHandler.FINISHED:
+            self.handle_close()
+
+    def handle_error(self):
+        traceback.print_exc()
+        self.handle_close()
+
+    def handle_close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.trace is not None:
+            self.finish_trace()
+        for item in self.outgoing:
+            if isinstance(item, _Body):
+                item.close()
+            elif isinstance(item, list) and hasattr(item[0], 'close'):
+                item[0].close()
+        self.outgoing.clear()
+        self.loop.unregister(self.fd)
+        self.loop.wheel.schedule(self, None)
+        self.socket.close()
+        self.server.connection_closed()
+
+    close = handle_close
+
+
+class _Body(object):
+    """A WSGI response iterable, queued to be consumed lazily. Generators
+    can yield a `Future` to wait for its result."""
+
+    def __init__(self, result):
+        self.result = result
+        self.iterator = iter(result)
+        self.started = False # the head is out
+        self.chunked = False
+        self.discard = False # no body for HEAD, 204 and 304
+        self.keep_alive = False
+        self.future = None
+        self.waiting = False
+
+    def next(self):
+        """Return the next chunk or a `Future`, raise `StopIteration` at
+        the end."""
+        future, self.future = self.future, None
+        if future is None:
+            return next(self.iterator)
+        if future.exception is not None:
+            return self.iterator.throw(future.exception)
+        return self.iterator.send(future.result)
+
+    def close(self):
+        if hasattr(self.result, 'close'):
+            self.result.close()
+
+def _encode(data):
+    if isinstance(data, unicode):
+        return data.encode('utf-8')
+    return data
+
 
+class HTTPServer(object):
+    """Serve `wsgiapp` on `loop`.
 
-class HTTPServer(asyncore.dispatcher):
+    Connections are accepted up to `accept_budget` at a time, so a burst
+    doesn't starve the ones already open, and accepting pauses while
+    `max_connections` are open, leaving new ones in the `backlog`.
+    `accepted` counts the connections accepted, `dropped` the ones reset
+    by the client before they could be, and `refused` the attempts that
+    failed for lack of file descriptors (accepting pauses for a moment).
 
-    def __init__(self, wsgiapp, host, port):
-        asyncore.dispatcher.__init__(self)
+    Connections are closed when idle for `keep_alive_timeout` seconds
+    between requests, when a request head isn't complete `header_timeout`
+    seconds after it started or no body data came in for `body_timeout`
+    seconds (with a 408 response), and when the client didn't read any of
+    the response for `write_timeout` seconds.
+
+    Given a `metrics` registry (see `trabant.metrics`), the server reports
+    its connections by phase and its counters there. Given a `tracer` (see
+    `trabant.tracing`), it traces the phases of every request.
+    """
+
+    def __init__(self, wsgiapp, host, port, keep_alive_timeout=15,
+            max_requests=100, parser_limits=None, spool_size=256 * 1024,
+            loop=None, sock=None, backlog=128, accept_budget=64,
+            max_connections=None, header_timeout=10, body_timeout=30,
+            write_timeout=30, metrics=None, tracer=None):
+        self.loop = loop or event_loop
+        self.keep_alive_timeout = keep_alive_timeout
+        self.header_timeout = header_timeout
+        self.body_timeout = body_timeout
+        self.write_timeout = write_timeout
+        self.max_requests = max_requests
+        # max_request_line, max_header_bytes, max_headers, see RequestParser
+        self.parser_limits = parser_limits or {}
+        self.spool_size = spool_size
+        self.accept_budget = accept_budget
+        self.max_connections = max_connections
         self.environ = {
             'trabant_server.close': self.close,
-            'wsgi.errors': None,
+            'trabant.loop': self.loop,
+            'wsgi.errors': sys.stderr,
             'wsgi.version': (1, 0),
             'wsgi.multithread': False,
             'wsgi.multiprocess': False,
             'wsgi.run_once': True,
+            'wsgi.file_wrapper': FileWrapper,
             #FIXME:
             'SERVER_NAME': host,
             'SERVER_PORT': port,
         }
         self.wsgiapp = wsgiapp
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.set_reuse_addr()
-        self.bind((host, port))
-        self.listen(2)
-
-    def handle_accept(self):
-        pair = self.accept()
-        if pair is None:
-            pass
-        else:
-            sock, addr = pair
-            handler = RequestHandler(sock, addr, self)
+        self.tracer = tracer
+        self.served = 0
+        # stop after serving this many requests, see `Master`
+        self.recycle_after = None
+        self.stopping = False
+        self.connections = 0
+        self.accepted = self.refused = self.dropped = 0
+        self.rejected = self.timeouts = 0
+        self.paused = False
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((host, port))
+            sock.listen(backlog)
+        # otherwise already listening, e.g. shared by the workers of a
+        # `Master`
+        self.socket = sock
+        self.socket.setblocking(0)
+        self.fd = self.socket.fileno()
+        self.loop.register(self.fd, self, EVENT_READ)
+        self.name = '%s:%d' % sock.getsockname()[:2]
+        if metrics is not None:
+            metrics.add_collector(self)
+
+    def handle_read(self):
+        for i in xrange(self.accept_budget):
+            if self.max_connections and \
+                    self.connections >= self.max_connections:
+                self.paused = True
+                return
+            try:
+                sock, addr = self.socket.accept()
+            except socket.error, why:
+                if why.args[0] in _WOULDBLOCK:
+                    return
+                if why.args[0] in _DISCONNECTED or \
+                        why.args[0] == errno.EPROTO:
+                    self.dropped += 1
+                    continue
+                if why.args[0] in _EXHAUSTED:
+                    self.refused += 1
+                    self.paused = True
+                    self.loop.call_later(ACCEPT_RETRY, self.resume)
+                    return
+                raise
+            self.accepted += 1
+            self.connections += 1
+            RequestHandler(sock, addr, self)
+
+    def handle_write(self):
+        pass
+
+    def handle_error(self):
+        traceback.print_exc()
+
+    def update_events(self):
+        if not self.stopping:
+            self.loop.set_events(self.fd, 0 if self.paused else EVENT_READ)
+
+    def resume(self):
+        if self.paused:
+            self.paused = False
+            self.update_events()
+
+    def connection_closed(self):
+        self.connections -= 1
+        if self.paused and self.connections < self.max_connections:
+            self.resume()
+
+    def collect(self):
+        """Samples for a metrics `Registry`, connections are looked at
+        only now."""
+        phases = dict.fromkeys(('idle', 'reading', 'handling', 'writing'), 0)
+        for handler in self.loop.handlers.values():
+            if isinstance(handler, RequestHandler) and handler.server is self:
+                phases[handler.phase()] += 1
+        labels = {'server': self.name}
+        for phase, count in sorted(phases.items()):
+            yield ('trabant_connections', 'gauge', 'Open connections',
+                    dict(labels, phase=phase), count)
+        for name, help, value in [
+                ('accepted', 'Connections accepted', self.accepted),
+                ('refused', 'Accepts failed for lack of file descriptors',
+                    self.refused),
+                ('dropped', 'Connections aborted before accept',
+                    self.dropped),
+                ('timeouts', 'Connections timed out', self.timeouts)]:
+            yield ('trabant_connections_%s_total' % name, 'counter', help,
+                    labels, value)
+        yield ('trabant_requests_served_total', 'counter',
+                'Requests served', labels, self.served)
+        yield ('trabant_requests_rejected_total', 'counter',
+                'Malformed requests, and connections over capacity, '
+                'answered with an error', labels,
+                self.rejected)
+
+    def request_done(self):
+        self.served += 1
+        if self.recycle_after and self.served >= self.recycle_after:
+            self.stop()
+
+    def close(self):
+        self.loop.unregister(self.fd)
+        self.socket.close()
+
+    def run(self, timeout=1.0):
+        """Serve until `stop` is called and the open connections are done."""
+        loop(timeout, self.loop)
+
+    def stop(self):
+        """Stop accepting connections, the ones open are closed once they
+        finish their current request."""
+        if not self.stopping:
+            self.stopping = True
+            self.close()
+            for handler in self.loop.handlers.values():
+                if isinstance(handler, RequestHandler) and \
+                        handler.server is self and handler.idle():
+                    handler.handle_close()
 
-def loop():
-    asyncore.loop()
 
+def loop(timeout=1.0, event_loop=event_loop):
+    while event_loop.alive():
+        event_loop.run_once(timeout)
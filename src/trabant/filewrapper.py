@@ -0,0 +1,153 @@
+import os
+import errno
+import uuid
+import select
+import socket
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        # pysendfile, same signature as os.sendfile
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
+
+# size of the chunks copied when sendfile is not available
+BLOCK_SIZE = 64 * 1024
+
+
+def file_length(filelike):
+    """Return the number of bytes left to read in `filelike`, or `None` if
+    it's not a regular file."""
+    # zip members and other sized files, checked first as a member's
+    # fileno() is the whole archive's
+    size = getattr(filelike, 'size', None)
+    if size is not None:
+        return size - filelike.tell()
+    try:
+        return os.fstat(filelike.fileno()).st_size - filelike.tell()
+    except (AttributeError, IOError, OSError, ValueError):
+        pass
+    return None
+
+
+class FileWrapper(object):
+    """`wsgi.file_wrapper` implementation.
+
+    Iterating over it copies the file in `blksize` chunks, but both servers
+    recognize it and send the file with `sendfile` when they can. `length`
+    limits the bytes sent from the current position (the rest of the file
+    by default). Positions are the file object's, `file_offset` is where
+    they start in the file of `fileno()` (not 0 for zip members).
+    """
+
+    def __init__(self, filelike, blksize=BLOCK_SIZE, length=None):
+        self.filelike = filelike
+        self.blksize = blksize
+        self.file_offset = getattr(filelike, 'file_offset', 0)
+        if length is None:
+            length = file_length(filelike)
+        self.length = length
+        if hasattr(filelike, 'close'):
+            self.close = filelike.close
+
+    def fileno(self):
+        return self.filelike.fileno()
+
+    def __iter__(self):
+        read = self.filelike.read
+        blksize = self.blksize
+        remaining = self.length
+        while remaining is None or remaining > 0:
+            if remaining is not None:
+                blksize = min(blksize, remaining)
+                remaining -= blksize
+            data = read(blksize)
+            if not data:
+                return
+            yield data
+
+
+def byteranges(ranges, length, content_type):
+    """Lay out a `multipart/byteranges` body for `ranges` (`(start, stop)`
+    pairs) of a file of `length` bytes. Returns the boundary, the total
+    length of the body, its parts as `(part_headers, start, stop)` and the
+    closing delimiter."""
+    boundary = uuid.uuid4().hex
+    parts = []
+    total = 0
+    for start, stop in ranges:
+        headers = ('\r\n--%s\r\nContent-Type: %s\r\n'
+                'Content-Range: bytes %d-%d/%d\r\n\r\n' % (boundary,
+                    content_type, start, stop - 1, length))
+        parts.append((headers, start, stop))
+        total += len(headers) + stop - start
+    trailer = '\r\n--%s--\r\n' % boundary
+    return boundary, total + len(trailer), parts, trailer
+
+def iter_byteranges(filelike, parts, trailer, blksize=BLOCK_SIZE):
+    """Iterate over a body laid out by `byteranges`, reading each range at
+    its offset."""
+    try:
+        for headers, start, stop in parts:
+            yield headers
+            filelike.seek(start)
+            for data in FileWrapper(filelike, blksize, stop - start):
+                yield data
+        yield trailer
+    finally:
+        filelike.close()
+
+
+def _wait_writable(sock):
+    """Wait for `sock` to take more data, up to its timeout."""
+    timeout = sock.gettimeout()
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        poller.register(sock.fileno(), select.POLLOUT)
+        ready = poller.poll(None if timeout is None else timeout * 1000)
+    else:
+        ready = select.select([], [sock], [], timeout)[1]
+    if not ready:
+        raise socket.timeout('timed out')
+
+def send_file(sock, filelike, offset, count):
+    """Write `count` bytes of `filelike` starting at `offset` to the
+    blocking socket `sock`. Uses `sendfile` when possible, otherwise falls
+    back to copying the file in `BLOCK_SIZE` chunks.
+
+    A socket with a timeout is non-blocking underneath, `sendfile` then
+    waits for it to be writable until the timeout expires."""
+    if sendfile is not None:
+        try:
+            out_fd, in_fd = sock.fileno(), filelike.fileno()
+            in_offset = getattr(filelike, 'file_offset', 0) + offset
+            while count > 0:
+                try:
+                    sent = sendfile(out_fd, in_fd, in_offset, count)
+                except OSError, e:
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        _wait_writable(sock)
+                        continue
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                if sent == 0:
+                    return
+                in_offset += sent
+                offset += sent
+                count -= sent
+            return
+        except (AttributeError, ValueError):
+            pass
+        except OSError, e:
+            if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                raise socket.error(e.errno, e.strerror)
+
+    filelike.seek(offset)
+    while count > 0:
+        data = filelike.read(min(count, BLOCK_SIZE))
+        if not data:
+            return
+        sock.sendall(data)
+        count -= len(data)
@@ -0,0 +1,207 @@
+"""Streaming parsers for `application/x-www-form-urlencoded` and
+`multipart/form-data` request bodies.
+
+`wsgi.input` is read in `CHUNK_SIZE` chunks, so memory use doesn't grow
+with the size of the body: fields are kept in memory up to
+`max_field_size`, uploaded files go to temporary files that are moved to
+disk once they're bigger than `spool_size`.
+"""
+
+import cgi
+import shutil
+from urllib import unquote_plus
+from tempfile import SpooledTemporaryFile
+
+from trabant.utils import MultiDict
+
+CHUNK_SIZE = 64 * 1024
+# uploads bigger than this are spooled to disk
+SPOOL_SIZE = 256 * 1024
+
+
+class FormError(ValueError):
+    """Malformed or oversized form, `status_code` is the response to send."""
+
+    def __init__(self, status_code, message):
+        ValueError.__init__(self, message)
+        self.status_code = status_code
+
+
+class FileUpload(object):
+    """A file part of a multipart form, its content is in `file`."""
+
+    def __init__(self, name, filename, content_type, spool_size=SPOOL_SIZE):
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.file = SpooledTemporaryFile(spool_size)
+        self.size = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def save(self, path):
+        """Copy the upload to `path`, in chunks."""
+        self.file.seek(0)
+        with open(path, 'wb') as f:
+            shutil.copyfileobj(self.file, f, CHUNK_SIZE)
+
+    def close(self):
+        self.file.close()
+
+    def __repr__(self):
+        return '<FileUpload %s %r %d bytes>' % (self.name, self.filename,
+                self.size)
+
+
+def _read(stream, length):
+    while length > 0:
+        data = stream.read(min(CHUNK_SIZE, length))
+        if not data:
+            raise FormError(400, 'Truncated request body')
+        length -= len(data)
+        yield data
+
+def _add(form, name, value, max_fields):
+    if name not in form and len(form) >= max_fields:
+        raise FormError(413, 'Too many fields')
+    form.add(name, value)
+
+
+def parse_urlencoded(stream, length, max_field_size=64 * 1024,
+        max_fields=1000):
+    """Parse `length` bytes of `name=value&...` from `stream` into a
+    `MultiDict`. Blank values are skipped, like `cgi.parse` does."""
+    form = MultiDict()
+    tail = ''
+    for data in _read(stream, length):
+        pairs = (tail + data).split('&')
+        tail = pairs.pop()
+        if len(tail) > max_field_size:
+            raise FormError(413, 'Field too large')
+        for pair in pairs:
+            _parse_pair(form, pair, max_fields)
+    _parse_pair(form, tail, max_fields)
+    return form
+
+def _parse_pair(form, pair, max_fields):
+    name, sep, value = pair.partition('=')
+    if sep and value:
+        _add(form, unquote_plus(name), unquote_plus(value), max_fields)
+
+
+def parse_multipart(stream, length, boundary, spool_size=SPOOL_SIZE,
+        max_field_size=64 * 1024, max_fields=1000, max_header_size=8192):
+    """Parse a `multipart/form-data` body of `length` bytes from `stream`
+    into a `MultiDict` of strings for plain fields and `FileUpload` for
+    files."""
+    if not boundary or len(boundary) > 70:
+        raise FormError(400, 'Invalid multipart boundary')
+    delimiter = '\r\n--' + boundary
+    keep = len(delimiter) + 1
+    form = MultiDict()
+    part = None # list of strings for fields, FileUpload for files
+    size = 0
+    state = 'preamble'
+    # the CRLF before the first delimiter is optional
+    buf = '\r\n'
+    chunks = _read(stream, length)
+    while True:
+        if state == 'preamble':
+            index = buf.find(delimiter)
+            if index < 0:
+                buf = buf[-keep:]
+            else:
+                buf = buf[index + len(delimiter):]
+                state = 'delimiter'
+                continue
+        elif state == 'delimiter':
+            if len(buf) >= 2:
+                if buf.startswith('--'):
+                    return form # the epilogue is ignored
+                index = buf.find('\r\n')
+                if index >= 0:
+                    buf = buf[index + 2:]
+                    state = 'headers'
+                    continue
+                if len(buf) > 1024:
+                    raise FormError(400, 'Invalid multipart delimiter')
+        elif state == 'headers':
+            head = None
+            if buf.startswith('\r\n'):
+                head, buf = '', buf[2:] # a part without headers
+            else:
+                index = buf.find('\r\n\r\n')
+                if index >= 0:
+                    head, buf = buf[:index], buf[index + 4:]
+                elif len(buf) > max_header_size:
+                    raise FormError(400, 'Multipart headers too large')
+            if head is not None:
+                name, filename, content_type = _part_headers(head)
+                if filename is None:
+                    part = []
+                else:
+                    part = FileUpload(name, filename, content_type,
+                            spool_size)
+                size = 0
+                state = 'body'
+                continue
+        else:
+            index = buf.find(delimiter)
+            data = buf[:index] if index >= 0 else buf[:-keep]
+            if data:
+                size += len(data)
+                if isinstance(part, list):
+                    if size > max_field_size:
+                        raise FormError(413, 'Field too large')
+                    part.append(data)
+                else:
+                    part.write(data)
+            if index >= 0:
+                if isinstance(part, FileUpload):
+                    part.file.seek(0)
+                    _add(form, name, part, max_fields)
+                else:
+                    _add(form, name, ''.join(part), max_fields)
+                buf = buf[index + len(delimiter):]
+                state = 'delimiter'
+                continue
+            buf = buf[len(data):]
+
+        try:
+            buf += next(chunks)
+        except StopIteration:
+            raise FormError(400, 'Truncated multipart body')
+
+def _part_headers(data):
+    disposition, content_type = '', 'text/plain'
+    for line in data.split('\r\n'):
+        header, sep, value = line.partition(':')
+        header = header.strip().lower()
+        if header == 'content-disposition':
+            disposition = value
+        elif header == 'content-type':
+            content_type = value.strip()
+    kind, options = cgi.parse_header(disposition)
+    if kind != 'form-data' or 'name' not in options:
+        raise FormError(400, 'Invalid multipart part')
+    return options['name'], options.get('filename'), content_type
+
+
+def parse_form(environ, spool_size=SPOOL_SIZE, max_field_size=64 * 1024,
+        max_fields=1000):
+    """Parse the body of a form submitted to `environ`, according to its
+    content type. Returns a `MultiDict`, empty for other bodies."""
+    content_type, params = cgi.parse_header(environ.get('CONTENT_TYPE', ''))
+    try:
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        raise FormError(400, 'Invalid Content-Length')
+    stream = environ['wsgi.input']
+    if content_type == 'application/x-www-form-urlencoded':
+        return parse_urlencoded(stream, length, max_field_size, max_fields)
+    if content_type == 'multipart/form-data':
+        return parse_multipart(stream, length, params.get('boundary'),
+                spool_size, max_field_size, max_fields)
+    return MultiDict()
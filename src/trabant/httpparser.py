@@ -0,0 +1,281 @@
+"""Incremental, bounded parser for HTTP/1.x request heads, shared by the
+servers.
+
+Data is fed as it comes from the socket, and oversized or malformed input
+is rejected as soon as it's seen, before the whole head is buffered.
+"""
+
+import re
+
+from trabant import utils
+
+_method = re.compile(r'^[!#$%&\'*+\-.^_`|~0-9A-Za-z]+$')
+_protocol = re.compile(r'^HTTP/(\d)\.(\d)$')
+
+# environ keys of the header names seen so far, bounded so that made up names
+# can't grow it without limit
+_keys = {}
+_MAX_KEYS = 1000
+
+
+class ParseError(Exception):
+    """Invalid or oversized request, `status_code` is the response to
+    send before closing the connection."""
+
+    def __init__(self, status_code, message):
+        Exception.__init__(self, message)
+        self.status_code = status_code
+
+
+class Headers(dict):
+    """Request headers by name, case insensitive."""
+
+    def __init__(self):
+        dict.__init__(self)
+        self.names = {}
+
+    def add(self, name, value):
+        key = name.lower()
+        if key in self.names:
+            name = self.names[key]
+            value = '%s, %s' % (dict.__getitem__(self, name), value)
+        else:
+            self.names[key] = name
+        dict.__setitem__(self, name, value)
+
+    def __getitem__(self, name):
+        return dict.__getitem__(self, self.names[name.lower()])
+
+    def __contains__(self, name):
+        return name.lower() in self.names
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+
+class RequestParser(object):
+    """Parse a request line and its headers into WSGI environ entries.
+
+    Call `feed` with data as it arrives, once `complete` is set `environ`,
+    `headers`, `method`, `target` and `protocol` are available.
+
+    The servers only frame request bodies with `Content-Length`, so heads
+    with a `Transfer-Encoding` are refused (501, or 400 if they also have
+    a `Content-Length`) rather than leaving a chunked body to be read as
+    the next request.
+    """
+
+    def __init__(self, max_request_line=8190, max_header_bytes=32768,
+            max_headers=100):
+        self.max_request_line = max_request_line
+        self.max_header_bytes = max_header_bytes
+        self.max_headers = max_headers
+        self.complete = False
+        self.environ = {}
+        self.headers = Headers()
+        self.method = self.target = self.protocol = None
+        self._buffer = ''
+        self._header_bytes = 0
+        self._last = None
+
+    def feed(self, data):
+        """Consume `data`, return what follows the end of the head (the
+        beginning of the body, or of a pipelined request) once it's
+        complete, `''` before. Raises `ParseError`."""
+        if self.complete:
+            return data
+        if self._buffer:
+            buf = self._buffer + data
+        elif self.protocol is None:
+            buf = data
+            if data[:1] not in ('\r', '\n'):
+                rest = self._feed_head(data)
+                if rest is not None:
+                    return rest
+        elif data[-1:] == '\n' and data.find('\n') == len(data) - 1:
+            # a single whole header line, as `readline` returns them
+            self._header_bytes += len(data)
+            if self._header_bytes > self.max_header_bytes:
+                raise ParseError(431, 'Request header fields too large')
+            line = data[:-2] if data[-2:-1] == '\r' else data[:-1]
+            if not line:
+                self._end_head()
+                return ''
+            self._header_line(line)
+            return ''
+        else:
+            buf = data
+        start = 0
+        while True:
+            end = buf.find('\n', start)
+            if end < 0:
+                break
+            line = buf[start:end]
+            size = end + 1 - start
+            start = end + 1
+            if line.endswith('\r'):
+                line = line[:-1]
+            if self.protocol is None:
+                self._request_line(line)
+            else:
+                self._header_bytes += size
+                if self._header_bytes > self.max_header_bytes:
+                    raise ParseError(431, 'Request header fields too large')
+                if not line:
+                    self._end_head()
+                    self._buffer = ''
+                    return buf[start:]
+                self._header_line(line)
+        self._buffer = buf[start:]
+        if self.protocol is None:
+            if len(self._buffer) > self.max_request_line:
+                raise ParseError(414, 'Request-URI too long')
+        elif self._header_bytes + len(self._buffer) > self.max_header_bytes:
+            raise ParseError(431, 'Request header fields too large')
+        return ''
+
+    def _feed_head(self, buf):
+        """Parse a head that's all in `buf` in one go, return what follows
+        it, or `None` if it's not complete, has bare LF line ends or is over
+        `max_header_bytes` (left to the line by line loop, that raises its
+        errors in the order of the lines)."""
+        end = buf.find('\r\n\r\n')
+        if end < 0:
+            return None
+        head = buf[:end]
+        lines = head.split('\r\n')
+        # header lines, their CRLFs and the blank line
+        header_bytes = end + 2 - len(lines[0])
+        if header_bytes > self.max_header_bytes or \
+                head.count('\n') != len(lines) - 1:
+            return None
+        self._request_line(lines[0])
+        self._header_bytes = header_bytes
+        environ = self.environ
+        headers = self.headers
+        names = headers.names
+        max_headers = self.max_headers
+        for i in xrange(1, len(lines)):
+            line = lines[i]
+            name, sep, value = line.partition(':')
+            # a known name (so a valid one) seen for the first time, the
+            # rest goes through `_header_line`
+            key = _keys.get(name) if sep else None
+            lower = name.lower()
+            if key is None or key == 'CONTENT_LENGTH' or key in environ or \
+                    lower in names or len(names) >= max_headers:
+                self._header_line(line)
+                continue
+            value = value.strip()
+            environ[key] = value
+            names[lower] = name
+            dict.__setitem__(headers, name, value)
+            self._last = (name, key)
+        self._end_head()
+        self._buffer = ''
+        return buf[end + 4:]
+
+    def _end_head(self):
+        # bodies are only framed by Content-Length: a chunked one would be
+        # read as the next request
+        if 'HTTP_TRANSFER_ENCODING' in self.environ:
+            if 'CONTENT_LENGTH' in self.environ:
+                raise ParseError(400, 'Both Transfer-Encoding and '
+                        'Content-Length')
+            raise ParseError(501, 'Transfer-Encoding not supported')
+        self.complete = True
+
+    def started(self):
+        """Whether any of the request has been fed."""
+        return self.protocol is not None or bool(self._buffer)
+
+    def limit(self):
+        """Number of bytes to read at most before the current line must end,
+        one more and `feed` raises `ParseError`. For blocking reads with
+        `readline`."""
+        if self.protocol is None:
+            return self.max_request_line + 3 - len(self._buffer)
+        return self.max_header_bytes + 1 - self._header_bytes - \
+                len(self._buffer)
+
+    def _request_line(self, line):
+        if len(line) > self.max_request_line:
+            raise ParseError(414, 'Request-URI too long')
+        if not line:
+            return # tolerate the CRLF some clients send after a body
+        parts = line.split(' ')
+        if len(parts) != 3:
+            raise ParseError(400, 'Bad request line')
+        method, target, protocol = parts
+        if not _method.match(method) or not target:
+            raise ParseError(400, 'Bad request line')
+        match = _protocol.match(protocol)
+        if match is None:
+            raise ParseError(400, 'Bad request version')
+        if match.group(1) != '1':
+            raise ParseError(505, 'HTTP version not supported')
+
+        if '://' in target and not target.startswith('/'):
+            # absolute form, used towards proxies
+            target = '/' + target.split('://', 1)[1].partition('/')[2]
+        path, _, query = target.partition('?')
+        self.method, self.target, self.protocol = method, target, protocol
+        self.environ.update({
+            'REQUEST_METHOD': method.upper(),
+            'SCRIPT_NAME': '',
+            'PATH_INFO': utils.unquote(path),
+            'QUERY_STRING': query,
+            'SERVER_PROTOCOL': protocol,
+        })
+
+    def _header_line(self, line):
+        environ = self.environ
+        if line[0] in ' \t':
+            # obsolete line folding, continues the previous header
+            if self._last is None:
+                raise ParseError(400, 'Bad header continuation')
+            name, key = self._last
+            if key == 'CONTENT_LENGTH':
+                raise ParseError(400, 'Bad Content-Length')
+            value = '%s %s' % (environ[key], line.strip())
+            environ[key] = value
+            dict.__setitem__(self.headers, self.headers.names[name.lower()],
+                    value)
+            return
+
+        name, sep, value = line.partition(':')
+        key = _keys.get(name) if sep else None
+        if key is None:
+            if not sep or not name or name != name.strip() or ' ' in name:
+                raise ParseError(400, 'Bad header line')
+            key = name.upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_' + key
+            if len(_keys) < _MAX_KEYS:
+                _keys[name] = key
+        headers = self.headers
+        if len(headers) >= self.max_headers and name not in headers:
+            raise ParseError(431, 'Too many headers')
+        value = value.strip()
+        if key in environ:
+            if key == 'CONTENT_LENGTH':
+                if environ[key] != value:
+                    raise ParseError(400, 'Conflicting Content-Length')
+                return
+            environ[key] = '%s, %s' % (environ[key], value)
+            headers.add(name, value)
+        else:
+            if key == 'CONTENT_LENGTH' and not value.isdigit():
+                raise ParseError(400, 'Bad Content-Length')
+            environ[key] = value
+            # first of its name, unless only the case differs
+            lower = name.lower()
+            if lower in headers.names:
+                headers.add(name, value)
+            else:
+                headers.names[lower] = name
+                dict.__setitem__(headers, name, value)
+        self._last = (name, key)
@@ -0,0 +1,221 @@
+"""Counters, gauges and fixed-bucket histograms, cheap enough to update on
+every request.
+
+Updates are plain attribute arithmetic and take no lock: the async server
+runs in a single thread, and with the threaded ones an increment can rarely
+be lost to a concurrent one, which is fine for monitoring.
+
+    requests = registry.counter('requests_total', 'Requests', ('route',))
+    requests.labels('^/$').inc()
+
+`App(routes, metrics=registry)` records requests and latencies per route,
+the servers' `metrics` argument exposes their connections, and
+`App(..., stats=True)` serves everything on `/_trabant/stats`, as JSON or
+in the Prometheus text format.
+"""
+
+import json
+import weakref
+from bisect import bisect_left
+from collections import OrderedDict
+
+# upper bounds of the default histogram buckets, in seconds
+BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5,
+        10)
+
+STATS_PATH = '/_trabant/stats'
+
+
+class Counter(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class Histogram(object):
+    """Count of the observations falling under each of `buckets`, the last
+    count is for those above them all."""
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @property
+    def value(self):
+        return self
+
+
+class Family(object):
+    """The metrics of a name, one per combination of label values."""
+
+    def __init__(self, kind, name, help, labelnames, factory):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.factory = factory
+        self.children = {} # label values -> metric
+
+    def labels(self, *values):
+        try:
+            return self.children[values]
+        except KeyError:
+            if len(values) != len(self.labelnames):
+                raise ValueError('%s takes labels %s' % (self.name,
+                    ', '.join(self.labelnames)))
+            return self.children.setdefault(values, self.factory())
+
+    def samples(self):
+        for values, metric in self.children.items():
+            yield dict(zip(self.labelnames, values)), metric.value
+
+
+class Registry(object):
+    """Metrics by name. Objects added with `add_collector` provide more
+    samples when the registry is read, from their `collect` method: `(name,
+    kind, help, labels, value)` tuples, computed on demand so they cost
+    nothing meanwhile. Collectors are only weakly referenced."""
+
+    def __init__(self):
+        self.families = OrderedDict()
+        self.collectors = weakref.WeakSet()
+
+    def _family(self, kind, name, help, labelnames, factory):
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = Family(kind, name, help,
+                    labelnames, factory)
+        elif family.kind != kind or family.labelnames != tuple(labelnames):
+            raise ValueError('%s is already registered differently' % name)
+        if not labelnames:
+            return family.labels()
+        return family
+
+    def counter(self, name, help, labelnames=()):
+        """Return the counter `name`, or its `Family` given `labelnames`."""
+        return self._family('counter', name, help, labelnames, Counter)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._family('gauge', name, help, labelnames, Gauge)
+
+    def histogram(self, name, help, labelnames=(), buckets=BUCKETS):
+        buckets = tuple(buckets)
+        return self._family('histogram', name, help, labelnames,
+                lambda: Histogram(buckets))
+
+    def add_collector(self, collector):
+        self.collectors.add(collector)
+
+    def collect(self):
+        """Return `(name, kind, help, samples)` for every metric, sorted by
+        name, samples being `(labels, value)` pairs."""
+        metrics = {}
+        for family in self.families.values():
+            metrics[family.name] = (family.name, family.kind, family.help,
+                    list(family.samples()))
+        for collector in list(self.collectors):
+            for name, kind, help, labels, value in collector.collect():
+                if name not in metrics:
+                    metrics[name] = (name, kind, help, [])
+                metrics[name][3].append((labels, value))
+        return [metrics[name] for name in sorted(metrics)]
+
+    def to_json(self):
+        result = OrderedDict()
+        for name, kind, help, samples in self.collect():
+            values = []
+            for labels, value in samples:
+                if isinstance(value, Histogram):
+                    value = {'buckets': _cumulative(value), 'sum': value.sum,
+                            'count': value.count}
+                values.append({'labels': labels, 'value': value})
+            result[name] = {'type': kind, 'help': help, 'values': values}
+        return json.dumps(result)
+
+    def to_prometheus(self):
+        """The metrics in the Prometheus text exposition format."""
+        lines = []
+        for name, kind, help, samples in self.collect():
+            lines.append('# HELP %s %s' % (name,
+                help.replace('\\', '\\\\').replace('\n', '\\n')))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in samples:
+                if not isinstance(value, Histogram):
+                    lines.append('%s%s %s' % (name, _labels(labels),
+                        _number(value)))
+                    continue
+                for le, count in _cumulative(value):
+                    bucket = dict(labels, le=le)
+                    lines.append('%s_bucket%s %d' % (name, _labels(bucket),
+                        count))
+                lines.append('%s_sum%s %s' % (name, _labels(labels),
+                    _number(value.sum)))
+                lines.append('%s_count%s %d' % (name, _labels(labels),
+                    value.count))
+        return '\n'.join(lines) + '\n'
+
+# shared by everything that isn't given its own
+registry = Registry()
+
+def _cumulative(histogram):
+    total = 0
+    buckets = []
+    for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+        total += count
+        buckets.append((_number(bound), total))
+    return buckets
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\',
+        '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in sorted(labels.items()))
+
+
+def stats_handler(registry=registry):
+    """An `App` route serving `registry`, in the Prometheus text format if
+    the query asks for `format=prometheus` or the client accepts
+    `text/plain` (as Prometheus does), as JSON otherwise."""
+    def _stats(environ):
+        query = environ.get('QUERY_STRING', '')
+        accept = environ.get('HTTP_ACCEPT', '')
+        if 'format=prometheus' in query or 'format=json' not in query and \
+                'text/plain' in accept and 'application/json' not in accept:
+            return [('Content-Type', 'text/plain; version=0.0.4')], \
+                    registry.to_prometheus()
+        return [('Content-Type', 'application/json')], registry.to_json()
+    return _stats
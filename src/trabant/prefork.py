@@ -0,0 +1,142 @@
+"""Pre-fork multi-process mode, for both servers.
+
+The master binds the listening socket and forks `workers` processes that
+accept connections on it. With `reuse_port`, each worker binds a socket of
+its own with `SO_REUSEPORT` instead, and the kernel spreads connections
+among them, though connections still queued on the socket of a worker
+that exits are reset. Workers that die are replaced. With `max_requests`,
+a worker stops accepting after serving that many requests, finishes the
+ones in progress and exits, and the master forks a fresh one.
+
+`make_server` is called in each worker with the listening socket:
+
+    def make_server(sock):
+        return HTTPServer(app, 'localhost', 8080, sock=sock)
+
+    Master(('localhost', 8080), make_server, workers=4).run()
+
+SIGTERM and SIGINT stop the master and its workers gracefully, SIGHUP
+replaces the workers with fresh ones.
+"""
+
+import os
+import sys
+import time
+import errno
+import signal
+import socket
+import traceback
+import multiprocessing
+
+try:
+    SO_REUSEPORT = socket.SO_REUSEPORT
+except AttributeError:
+    SO_REUSEPORT = 15 if sys.platform.startswith('linux') else None
+
+# workers that fail sooner than this are restarted after a pause
+MIN_LIFETIME = 1.0
+
+
+def listen_socket(address, backlog=128, reuse_port=False):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.bind(address)
+    sock.listen(backlog)
+    return sock
+
+
+class Master(object):
+
+    def __init__(self, address, make_server, workers=None, max_requests=None,
+            reuse_port=False, backlog=128, graceful_timeout=30):
+        if reuse_port and SO_REUSEPORT is None:
+            raise ValueError('SO_REUSEPORT is not available')
+        self.address = address
+        self.make_server = make_server
+        self.size = workers or multiprocessing.cpu_count()
+        self.max_requests = max_requests
+        self.reuse_port = reuse_port
+        self.backlog = backlog
+        self.graceful_timeout = graceful_timeout
+        self.workers = {} # pid -> start time
+        self.socket = None
+        self.running = False
+
+    def run(self):
+        if not self.reuse_port:
+            self.socket = listen_socket(self.address, self.backlog)
+        self.running = True
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+        for i in range(self.size):
+            self.spawn()
+
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            started = self.workers.pop(pid, None)
+            if started is None or not self.running:
+                continue
+            if status and time.time() - started < MIN_LIFETIME:
+                # failing at startup, don't fork in a tight loop
+                time.sleep(MIN_LIFETIME)
+            self.spawn()
+        if self.socket is not None:
+            self.socket.close()
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = time.time()
+            return
+        status = 0
+        try:
+            self.work()
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+
+    def work(self):
+        for signum in (signal.SIGTERM, signal.SIGHUP):
+            signal.signal(signum, signal.SIG_DFL)
+        # ^C reaches the whole process group, the master takes care of it
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        sock = self.socket
+        if sock is None:
+            sock = listen_socket(self.address, self.backlog, True)
+        server = self.make_server(sock)
+        server.recycle_after = self.max_requests
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+        server.run()
+
+    def signal_workers(self, signum):
+        for pid in self.workers:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def handle_stop(self, signum, frame):
+        if not self.running:
+            # stopping already, don't wait for the workers any longer
+            self.signal_workers(signal.SIGKILL)
+            return
+        self.running = False
+        self.signal_workers(signal.SIGTERM)
+        signal.signal(signal.SIGALRM, self.handle_stop)
+        signal.alarm(self.graceful_timeout)
+
+    def handle_reload(self, signum, frame):
+        # stopped workers are replaced as they exit
+        self.signal_workers(signal.SIGTERM)
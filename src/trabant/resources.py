@@ -0,0 +1,189 @@
+"""Load static files and templates from zip archives.
+
+An archive is opened and mapped in memory once, and its members indexed by
+name, so a lookup is a dict access. Stored (uncompressed) members are read
+straight from the mapping, deflated ones are inflated when opened.
+
+`module` can be a `ZipResources`, the path of a zip file, or the name of a
+module: for modules imported from a zip (zipimport, eggs, frozen bundles)
+names are looked up in the archive, relative to the module's directory,
+otherwise in the module's directory on disk.
+"""
+
+import io
+import os
+import sys
+import mmap
+import posixpath
+import zlib
+import errno
+import struct
+import zipfile
+import threading
+from datetime import datetime
+from collections import namedtuple
+
+_local_header = struct.Struct('<4s5H3L2H')
+
+ZipMember = namedtuple('ZipMember', 'offset size compressed method crc mtime')
+
+
+class MemberFile(object):
+    """Read-only file object over `size` bytes of `data` (the archive's
+    memory map for stored members) starting at `offset`.
+
+    Stored members are also given the archive file `fp`: `fileno()` is its
+    descriptor and `file_offset` where the member starts in it, so that the
+    servers send them with `sendfile` rather than copying them out of the
+    mapping."""
+
+    def __init__(self, data, offset, size, fp=None):
+        self.data = data
+        self.offset = offset
+        self.size = size
+        self.fp = fp
+        self.pos = 0
+
+    def fileno(self):
+        if self.fp is None:
+            raise io.UnsupportedOperation('in-memory member')
+        return self.fp.fileno()
+
+    @property
+    def file_offset(self):
+        return self.offset
+
+    def read(self, size=-1):
+        if size < 0 or self.pos + size > self.size:
+            size = self.size - self.pos
+        start = self.offset + self.pos
+        self.pos += size
+        return self.data[start:start + size]
+
+    def readline(self, size=-1):
+        end = self.data.find('\n', self.offset + self.pos,
+                self.offset + self.size)
+        if end < 0:
+            return self.read(size)
+        length = end + 1 - self.offset - self.pos
+        if size >= 0:
+            length = min(length, size)
+        return self.read(length)
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.pos
+        elif whence == 2:
+            pos += self.size
+        self.pos = max(0, min(pos, self.size))
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        pass
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+
+class ZipResources(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.fp = open(path, 'rb')
+        self.data = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self.index = self._build_index()
+
+    def _build_index(self):
+        index = {}
+        archive = zipfile.ZipFile(self.fp)
+        try:
+            for info in archive.infolist():
+                header = self.data[info.header_offset:
+                        info.header_offset + _local_header.size]
+                fields = _local_header.unpack(header)
+                offset = (info.header_offset + _local_header.size +
+                        fields[-2] + fields[-1])
+                mtime = datetime(*info.date_time)
+                index[info.filename] = ZipMember(offset, info.file_size,
+                        info.compress_size, info.compress_type, info.CRC,
+                        mtime)
+        finally:
+            archive.close()
+        return index
+
+    def info(self, name):
+        """Return the `ZipMember` for `name`, or `None`."""
+        name = posixpath.normpath(name.replace(os.sep, '/')).lstrip('/')
+        return self.index.get(name)
+
+    def open(self, name):
+        member = self.info(name)
+        if member is None:
+            raise IOError(errno.ENOENT, 'No such resource', name)
+        if member.method == zipfile.ZIP_STORED:
+            return MemberFile(self.data, member.offset, member.size,
+                    self.fp)
+        if member.method == zipfile.ZIP_DEFLATED:
+            data = self.data[member.offset:member.offset + member.compressed]
+            data = zlib.decompress(data, -zlib.MAX_WBITS)
+            return MemberFile(data, 0, len(data))
+        raise IOError(errno.EINVAL, 'Unsupported compression method', name)
+
+    def close(self):
+        self.data.close()
+        self.fp.close()
+
+
+_archives = {} # archive path -> ZipResources
+_modules = {} # module -> (archive, prefix) or (None, directory)
+_lock = threading.Lock()
+
+def get_archive(path):
+    """Return the (shared) `ZipResources` for the zip file at `path`."""
+    try:
+        return _archives[path]
+    except KeyError:
+        pass
+    with _lock:
+        if path not in _archives:
+            _archives[path] = ZipResources(path)
+    return _archives[path]
+
+def _resolve(module):
+    if isinstance(module, ZipResources):
+        return module, ''
+    if module not in sys.modules and os.path.isfile(module):
+        return get_archive(module), ''
+    mod = sys.modules.get(module) or __import__(module, fromlist=['_'])
+    directory = os.path.dirname(mod.__file__)
+    loader = getattr(mod, '__loader__', None)
+    if not hasattr(loader, 'archive'):
+        return None, directory
+    prefix = os.path.relpath(directory, loader.archive)
+    if prefix == os.curdir:
+        prefix = ''
+    return get_archive(loader.archive), prefix
+
+def locate(path, module):
+    """Return `(archive, name)` for a resource in a zip archive, or
+    `(None, filename)` for one on disk."""
+    try:
+        archive, prefix = _modules[module]
+    except KeyError:
+        archive, prefix = _modules[module] = _resolve(module)
+    return archive, os.path.join(prefix, path)
+
+def opener(path, mode='r', module=None):
+    """Open `path`, from `module`'s archive if given (see `locate`)."""
+    if module is None:
+        return open(path, mode)
+    archive, name = locate(path, module)
+    if archive is None:
+        return open(name, mode)
+    return archive.open(name)
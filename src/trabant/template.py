@@ -1,33 +1,253 @@
 import re
 import cgi
+import imp
+import hashlib
+import sys
+import marshal
 import tokenize
 import os
+import time
 import warnings
-try:
-    from resources import opener
-except ImportError:
-    warnings.warn("Unable to load module `resources`, Trabant will be "
-            "unable to load static resources contained in zip file")
-    opener = open
+import threading
+from collections import OrderedDict
+from trabant.resources import opener
+from trabant import tracing as _tracing
 
 from trabant.utils import touni
 
+class TemplateCache(object):
+    """LRU cache of compiled templates, keyed by resolved path.
+
+    `check_interval` controls mtime invalidation: `None` never looks at the
+    file again, `0` stats it on every lookup, otherwise at most once every
+    `check_interval` seconds.
+    """
+
+    def __init__(self, size=128, check_interval=None):
+        self.size = size
+        self.check_interval = check_interval
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() # key -> [template, mtime, checked]
+        self._lock = threading.Lock()
+
+    def get(self, key, load, path=None):
+        """Return the template cached under `key`, calling `load()` to build
+        it on a miss. `path` is the file to stat for mtime checks."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+        if entry is not None:
+            if path is None or self.check_interval is None or \
+                    now - entry[2] < self.check_interval:
+                self.hits += 1
+                return entry[0]
+            entry[2] = now
+            if _mtime(path) == entry[1]:
+                self.hits += 1
+                return entry[0]
+
+        self.misses += 1
+        mtime = path and _mtime(path)
+        template = load()
+        with self._lock:
+            self._entries[key] = [template, mtime, now]
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return template
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        self.hits = self.misses = 0
+
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits,
+                'misses': self.misses}
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+# shared by all the renderers that don't bring their own
+template_cache = TemplateCache()
+
+class FragmentCache(object):
+    """LRU cache of the output of `%cache` blocks, bounded to `size`
+    entries and `max_chars` characters of output overall."""
+
+    def __init__(self, size=1024, max_chars=4 * 1024 * 1024):
+        self.size = size
+        self.max_chars = max_chars
+        self.chars = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() # key -> (expires, chars, chunks)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the chunks cached under `key`, `None` if there are none
+        or they expired."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                if entry[0] > time.time():
+                    self._entries[key] = entry
+                    self.hits += 1
+                    return entry[2]
+                self.chars -= entry[1]
+            self.misses += 1
+        return None
+
+    def put(self, key, chunks, ttl):
+        chunks = tuple(chunks)
+        chars = sum(map(len, chunks))
+        if chars > self.max_chars:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.chars -= old[1]
+            self._entries[key] = (time.time() + ttl, chars, chunks)
+            self.chars += chars
+            while len(self._entries) > self.size or \
+                    self.chars > self.max_chars:
+                self.chars -= self._entries.popitem(last=False)[1][1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.chars = 0
+        self.hits = self.misses = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'size': len(self._entries), 'chars': self.chars,
+                'hits': self.hits, 'misses': self.misses,
+                'hit_rate': lookups and float(self.hits) / lookups}
+
+# the output of `%cache` blocks, for every template
+fragment_cache = FragmentCache()
+
+_cache_line = re.compile(r'^cache\s+(.+?)\s+(\d+(?:\.\d*)?|\.\d+)$')
+
+def _cache_directive(line):
+    """Return the key expression and ttl of a `%cache <key-expr> <ttl>`
+    line, `None` if it's Python code (`% cache = 3`)."""
+    m = _cache_line.match(line)
+    if m is None:
+        return None
+    try:
+        compile(m.group(1), '<cache key>', 'eval')
+    except SyntaxError:
+        return None
+    return m.groups()
+
+# name of the precompiled bundle written by `compile_bundle`, looked up in
+# the root of the renderer path
+BUNDLE = 'templates.bundle'
+# layout of a bundle's entries, `(encoding, co, stream_co)` since 2
+BUNDLE_FORMAT = 2
+# version of the code generated by `Template.translate`, bundles built by
+# another one (or with another layout) are ignored
+CODE_VERSION = 'trabant-3'
+
+def _bundle_magic():
+    return '%sbundle-%d/%s' % (imp.get_magic(), BUNDLE_FORMAT, CODE_VERSION)
+
+def compile_bundle(path, ext=None, output=None):
+    """Translate and compile every template under `path` and marshal the
+    code objects in a single bundle, that `Renderer` loads instead of the
+    sources. The bundle is tied to the interpreter version that built it.
+    Returns the names of the compiled templates."""
+    if output is None:
+        output = os.path.join(path, BUNDLE)
+    templates = {}
+    for root, dirs, files in os.walk(path):
+        for filename in files:
+            if ext is not None and not filename.endswith('.' + ext):
+                continue
+            filepath = os.path.join(root, filename)
+            if os.path.abspath(filepath) == os.path.abspath(output):
+                continue
+            name = os.path.relpath(filepath, path).replace(os.sep, '/')
+            with open(filepath) as f:
+                t = Template(f.read(), filename=name)
+            templates[name] = (t.encoding, t.co, t.get_stream_co())
+    with open(output, 'wb') as f:
+        marshal.dump((_bundle_magic(), templates), f)
+    return sorted(templates)
+
 class Renderer:
-    def __init__(self, path='', ext=None, constants={}, module=None):
+    def __init__(self, path='', ext=None, constants={}, module=None,
+            cache=None, bufsize=None):
         self.path = path
         self.ext = ext
         self.constants = constants
         self.module = module
-        #self._cache = {}
+        if cache is None:
+            cache = template_cache
+        self.cache = cache
+        if bufsize is None:
+            bufsize = Template.bufsize
+        self.bufsize = bufsize
+        self.bundle = self.load_bundle()
+
+    def load_bundle(self):
+        try:
+            if self.module:
+                f = opener(os.path.join(self.path, BUNDLE), 'rb',
+                        module=self.module)
+            else:
+                f = opener(os.path.join(self.path, BUNDLE), 'rb')
+        except IOError:
+            return {}
+        try:
+            magic, templates = marshal.loads(f.read())
+        except (EOFError, ValueError, TypeError):
+            return {}
+        finally:
+            f.close()
+        if magic != _bundle_magic():
+            warnings.warn("Ignoring template bundle in `%s`, built by a "
+                    "different Python or trabant version" % self.path)
+            return {}
+        return templates
 
     def lookup(self, name, lookup_path=None):
         if self.ext is not None:
             name = '.'.join((name, self.ext))
 
         if self.module:
-            f = opener(os.path.join(self.path, name), module=self.module)
+            path = os.path.join(self.path, name)
+            return self.cache.get((self.module, path),
+                    lambda: self.load(name))
+
+        path = os.path.abspath(os.path.join(self.path, name))
+        if name in self.bundle:
+            return self.cache.get(path, lambda: self.load(name))
+        return self.cache.get(path, lambda: self.load(name), path)
+
+    def load(self, name):
+        if _tracing.enabled:
+            return _tracing.timed('compile', lambda: self._load(name))
+        return self._load(name)
+
+    def _load(self, name):
+        if name in self.bundle:
+            encoding, co, stream_co = self.bundle[name]
+            return Template(co=co, stream_co=stream_co, encoding=encoding,
+                    renderer=self)
+
+        path = os.path.join(self.path, name)
+        if self.module:
+            f = opener(path, module=self.module)
         else:
-            f = opener(os.path.join(self.path, name))
+            f = opener(path)
 
         t = Template(f.read(), renderer=self)
         f.close()
@@ -37,21 +257,34 @@ class Renderer:
     def __call__(self, name, **kw):
         kw.update(self.constants)
         t = self.lookup(name)
+        if _tracing.enabled:
+            return _tracing.timed('render', lambda: t.render(**kw))
         return t.render(**kw)
 
+    def stream(self, name, **kw):
+        kw.update(self.constants)
+        t = self.lookup(name)
+        return t.stream(kw, _bufsize=self.bufsize)
+
 class Template:
     settings = {} #used in prepare()
-    defaults = {} #used in render()
+    defaults = {} #used in prepare()
+
+    bufsize = 8192 #used in stream()
+    fragments = fragment_cache #used by %cache
 
     blocks = ('if','elif','else','try','except','finally','for','while','with','def','class')
     dedent_blocks = ('elif', 'else', 'except', 'finally')
 
-    def __init__(self, source=None, encoding='utf-8', renderer=None, **settings):
+    def __init__(self, source=None, encoding='utf-8', renderer=None,
+            filename=None, co=None, stream_co=None, **settings):
         """ Create a new template.
         If the source parameter (str or buffer) is missing, the name argument
         is used to guess a template filename. Subclasses can assume that
         self.source and/or self.filename are set. Both are strings.
         The encoding parameter should be used to decode byte strings or files.
+        Precompiled code objects can be passed as `co` and `stream_co`,
+        skipping translation.
         """
         if hasattr(source, 'read'):
             self.source = source.read()
@@ -59,28 +292,49 @@ class Template:
             self.source = source
         self.encoding = encoding
         self.renderer = renderer
+        self.filename = filename
+        self.co = co
+        self.stream_co = stream_co
         self.prepare(**self.settings)
 
     def prepare(self, escape_func=cgi.escape, noescape=False):
-        self.cache = {}
-        if self.source:
+        if self.co is not None:
+            self.code = None
+        elif self.source:
             self.code = self.translate(self.source)
-            self.co = compile(self.code, '<string>', 'exec')
+            self.co = _compile(self.code, self.filename or '<string>')
         else:
             self.code = self.translate(opener(self.filename).read())
-            self.co = compile(self.code, self.filename, 'exec')
+            self.co = _compile(self.code, self.filename)
         enc = self.encoding
-        self._str = lambda x: touni(x, enc)
-        self._escape = lambda x: escape_func(touni(x, enc))
+        if escape_func is cgi.escape:
+            self._str, self._escape = _converters(enc)
+        else:
+            self._str = lambda x: touni(x, enc)
+            self._escape = lambda x: escape_func(touni(x, enc))
         if noescape:
             self._str, self._escape = self._escape, self._str
+        # what every render starts from
+        self._globals = self.defaults.copy()
+        self._globals.update({'_str': self._str, '_escape': self._escape,
+            '_fragments': self.fragments})
+        if _calls_locals(self.co):
+            self._globals['locals'] = _template_locals
 
-    def translate(self, template):
+    def translate(self, template, stream=False):
         stack = [] # Current Code indentation
         lineno = 0 # Current line of code
         ptrbuffer = [] # Buffer for printable strings and token tuple instances
         codebuffer = [] # Buffer for generated python code
+        caches = [] # (lineno, ttl) of the open %cache blocks
+        rebase = False # whether there's a %rebase
         multiline = dedent = oneline = False
+        # %cache keys are prefixed with the template's name, or its source
+        if self.filename:
+            name = self.filename
+        else:
+            name = hashlib.md5(template.encode('utf-8')
+                    if isinstance(template, unicode) else template).hexdigest()
 
         def yield_tokens(line):
             for i, part in enumerate(re.split(r'\{\{(.*?)\}\}', line)):
@@ -107,20 +361,33 @@ class Template:
 
         def flush(): # Flush the ptrbuffer
             if not ptrbuffer: return
-            cline = ''
+            parts = [] # adjacent text is merged in a single constant
             for line in ptrbuffer:
                 for token, value in line:
-                    if token == 'TXT': cline += repr(value)
-                    elif token == 'RAW': cline += '_str(%s)' % value
-                    elif token == 'CMD': cline += '_escape(%s)' % value
-                    cline +=  ', '
-                cline = cline[:-2] + '\\\n'
-            cline = cline[:-2]
-            if cline[:-1].endswith('\\\\\\\\\\n'):
-                cline = cline[:-7] + cline[-1] # 'nobr\\\\\n' --> 'nobr'
-            cline = '_printlist([' + cline + '])'
+                    if token == 'RAW':
+                        parts.append((False, '_tostr(%s)' % value))
+                    elif token == 'CMD':
+                        parts.append((False, '_esc(%s)' % value))
+                    elif parts and parts[-1][0]:
+                        parts[-1] = (True, parts[-1][1] + value)
+                    elif value:
+                        parts.append((True, value))
+            if parts and parts[-1][0] and parts[-1][1].endswith('\\\\\n'):
+                parts[-1] = (True, parts[-1][1][:-3]) # 'nobr\\\\\n' --> 'nobr'
+            items = [repr(value) if text else value
+                    for text, value in parts if value]
             del ptrbuffer[:] # Do this before calling code() again
-            code(cline)
+            if len(items) == 1:
+                code('_write(%s)' % items[0])
+            elif items:
+                code('_extend((%s))' % ', '.join(items))
+            if stream: flush_point()
+
+        def flush_point(): # Let the stream generator yield, not in functions
+            # nor in %cache blocks, whose output must stay in _stdout
+            if 'def' not in stack and 'class' not in stack and \
+                    'cache' not in stack:
+                code(STREAM_FLUSH)
 
         def code(stmt):
             for line in stmt.splitlines():
@@ -154,6 +421,25 @@ class Template:
                         multiline = False
                     if not oneline and not multiline:
                         stack.append(cmd)
+                elif cmd == 'cache' and _cache_directive(cline):
+                    # %cache <key-expr> <ttl>: the output of the block is
+                    # kept in `fragments`, under the key's value, for ttl
+                    # seconds, and replayed without running the block
+                    key, ttl = _cache_directive(cline)
+                    code('_fk%d = (%r, %d, (%s))' % (lineno, name, lineno, key))
+                    code('_fc%d = _fragments.get(_fk%d)' % (lineno, lineno))
+                    code('if _fc%d is not None: _extend(_fc%d)' % (
+                        lineno, lineno))
+                    code('else:')
+                    stack.append('cache')
+                    caches.append((lineno, ttl))
+                    code('_fs%d = len(_stdout)' % lineno)
+                elif cmd == 'end' and stack and stack[-1] == 'cache':
+                    start, ttl = caches.pop()
+                    code('_fragments.put(_fk%d, _stdout[_fs%d:], %s)' % (
+                        start, start, ttl))
+                    stack.pop()
+                    if stream: flush_point()
                 elif cmd == 'end' and stack:
                     code('#end(%s) %s' % (stack.pop(), line.strip()[3:]))
                 elif cmd == 'include':
@@ -163,8 +449,10 @@ class Template:
                     elif p:
                         code("_=_include(%s, _stdout)" % repr(p[0]))
                     else: # Empty %include -> reverse of %rebase
-                        code("_printlist(_base)")
+                        code("_extend(_base)")
+                    if stream: flush_point()
                 elif cmd == 'rebase':
+                    rebase = True
                     p = cline.split(None, 2)[1:]
                     if len(p) == 2:
                         code("globals()['_rebase']=(%s, dict(%s))" % (repr(p[0]), p[1]))
@@ -177,25 +465,46 @@ class Template:
                     line = line.replace('%%', '%', 1)
                 ptrbuffer.append(yield_tokens(line))
         flush()
+        if rebase:
+            # the whole output becomes the layout's `_base`, it can't be
+            # streamed before the layout is known
+            codebuffer = [line for line in codebuffer
+                    if line.strip() != STREAM_FLUSH]
         return '\n'.join(codebuffer) + '\n'
 
 
-    def execute(self, _stdout, *args, **kwargs):
+    def get_stream_co(self):
+        """Compile the template as a generator function, `_template`, that
+        yields whenever the output buffer grows past `_bufsize`. Names
+        assigned by the template are declared global, so they behave as in
+        the plain module-level code."""
+        if self.stream_co is None:
+            if self.source:
+                source = self.source
+            else:
+                source = opener(self.filename).read()
+            code = self.translate(source, stream=True)
+            self.stream_co = _compile(code, self.filename or '<string>', True)
+        return self.stream_co
+
+    def _env(self, _stdout, kwargs):
         def subtemplate(_name, _stdout, *innerargs, **innerkwargs):
             for dictarg in innerargs: innerkwargs.update(dictarg)
             innerkwargs.update(kwargs)
-            #FIXME: cache should be class-scoped?
-            if _name not in self.cache:
-                self.cache[_name] = self.renderer.lookup(_name)
-            return self.cache[_name].execute(_stdout, innerkwargs)
+            return self.renderer.lookup(_name).execute(_stdout, innerkwargs)
 
-        for dictarg in args: kwargs.update(dictarg)
-        env = self.defaults.copy()
-        env.update({'_stdout': _stdout, '_printlist': _stdout.extend,
-               '_include': subtemplate, '_str': self._str,
-               '_escape': self._escape})
+        env = self._globals.copy()
+        env['_stdout'] = _stdout
+        env['_printlist'] = _stdout.extend
+        env['_include'] = subtemplate
         env.update(kwargs)
+        return env
+
+    def execute(self, _stdout, *args, **kwargs):
+        for dictarg in args: kwargs.update(dictarg)
+        env = self._env(_stdout, kwargs)
         eval(self.co, env)
+        env['_template']()
         if '_rebase' in env:
             subtpl, rargs = env['_rebase']
             subtpl = self.renderer.lookup(subtpl)
@@ -211,3 +520,123 @@ class Template:
         self.execute(stdout, kwargs)
         return ''.join(stdout)
 
+    def stream(self, *args, **kwargs):
+        """ Render the template as an iterator of chunks of at least
+        `_bufsize` characters (defaults to `Template.bufsize`). """
+        bufsize = kwargs.pop('_bufsize', self.bufsize)
+        for dictarg in args: kwargs.update(dictarg)
+        return self._stream(bufsize, kwargs)
+
+    def _stream(self, bufsize, kwargs):
+        stdout = _StreamBuffer()
+        env = self._env(stdout, kwargs)
+        env['_bufsize'] = bufsize
+        eval(self.get_stream_co(), env)
+        # templates with a %rebase have no flush point, see `translate`
+        for _ in env['_template']():
+            yield ''.join(stdout)
+            del stdout[:]
+            stdout.size = 0
+        if '_rebase' in env:
+            subtpl, rargs = env['_rebase']
+            rargs['_base'] = stdout[:]
+            for chunk in self.renderer.lookup(subtpl)._stream(bufsize, rargs):
+                yield chunk
+        elif stdout:
+            yield ''.join(stdout)
+
+
+STREAM_FLUSH = 'if _stdout.size >= _bufsize: yield'
+
+# the output functions, bound to fast locals of `_template`
+_PROLOGUE = ['_write = _stdout.append', '_extend = _stdout.extend',
+        '_esc = _escape', '_tostr = _str']
+_LOCALS = ('_write', '_extend', '_esc', '_tostr')
+
+def _wrap(code, names, stream):
+    lines = ['def _template():']
+    if names:
+        lines.append('  global %s' % ', '.join(names))
+    if stream:
+        lines.append('  if False: yield')
+    lines.extend('  ' + line for line in _PROLOGUE)
+    lines.extend('  ' + line for line in code.splitlines())
+    return '\n'.join(lines) + '\n'
+
+def _compile(code, filename, stream=False):
+    """Compile translated template `code` as a function, `_template`, a
+    generator that yields whenever the output buffer grows past `_bufsize`
+    with `stream`. Names assigned by the template are declared global, so
+    they behave as in plain module-level code, only the output functions
+    are locals."""
+    co = compile(_wrap(code, (), stream), filename, 'exec')
+    inner = [c for c in co.co_consts if hasattr(c, 'co_varnames')][0]
+    names = [name for name in inner.co_varnames + inner.co_cellvars
+            if name not in _LOCALS]
+    return compile(_wrap(code, names, stream), filename, 'exec')
+
+def _template_locals():
+    """`locals()` for templates: the render namespace at their top level,
+    whose names are globals of `_template`, as when the template code ran
+    at module level."""
+    frame = sys._getframe(1)
+    if frame.f_code.co_name == '_template':
+        return frame.f_globals
+    return frame.f_locals
+
+def _calls_locals(co):
+    # only then, as every name in the render namespace slows the others
+    return 'locals' in co.co_names or any(_calls_locals(c)
+            for c in co.co_consts if hasattr(c, 'co_names'))
+
+def _converters(encoding):
+    """`_str` and `_escape` for `touni` and `cgi.escape`, in a single call
+    and returning values that need no escaping as they are."""
+    def _str(x):
+        if isinstance(x, unicode):
+            return x
+        if isinstance(x, str):
+            return unicode(x, encoding)
+        return str(x)
+
+    def _escape(x):
+        cls = type(x)
+        if cls is int:
+            return str(x)
+        if cls is not unicode:
+            x = unicode(x, encoding) if isinstance(x, str) else str(x)
+        if '&' in x or '<' in x or '>' in x:
+            return x.replace('&', '&amp;').replace('<', '&lt;').replace(
+                    '>', '&gt;')
+        return x
+    return _str, _escape
+
+class _StreamBuffer(list):
+    """Output list that keeps track of the characters it holds."""
+    size = 0
+
+    def append(self, item):
+        self.size += len(item)
+        list.append(self, item)
+
+    def extend(self, items):
+        items = list(items)
+        self.size += sum(map(len, items))
+        list.extend(self, items)
+
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m trabant.template')
+    commands = parser.add_subparsers()
+    command = commands.add_parser('compile',
+            help='precompile the templates in a directory into a bundle')
+    command.add_argument('path')
+    command.add_argument('--ext', help='only compile files with this extension')
+    command.add_argument('-o', '--output', help='defaults to PATH/%s' % BUNDLE)
+    args = parser.parse_args(argv)
+    for name in compile_bundle(args.path, args.ext, args.output):
+        print name
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -78,11 +78,19 @@ __license__ = 'GNU General Public License (GPL)'
 from SocketServer import ThreadingMixIn
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 from urlparse import urlparse
+from Queue import Queue, Full
 import threading
 import socket
+import time
 import mimetypes
 import sys
 import os
+import traceback
+
+from trabant.async_server import EventLoop, EVENT_READ
+from trabant.filewrapper import FileWrapper, send_file, byteranges
+from trabant.httpparser import RequestParser, ParseError
+from trabant.utils import accepts_encoding, parse_range
 
 
 # XXX: http://bugs.python.org/issue6085
@@ -122,7 +130,114 @@ HTTP_ERROR_TEMPLATE = """<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">
 </body></html>"""
 
 
+class LimitedInput(object):
+    """`wsgi.input` reading at most `length` bytes from the connection, so
+    what the application leaves unread can be skipped before the next
+    request on a persistent connection."""
+
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.readline(size)
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=None):
+        return list(self)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def drain(self):
+        while self.remaining and self.read(8192):
+            pass
+
+
 class WSGIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # the head and the body are written separately, don't let Nagle's
+    # algorithm hold the body back until the head is acknowledged
+    disable_nagle_algorithm = True
+    # handed back to the server between requests, see `PoolMixIn`
+    parked = False
+
+    def setup(self):
+        self.timeout = self.server.keep_alive_timeout
+        BaseHTTPRequestHandler.setup(self)
+
+    def handle(self):
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection:
+            if self.server.park(self):
+                self.parked = True
+                return
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        """Read the request head with the shared `RequestParser` (instead of
+        `parse_request`), so the server's limits apply as it's read."""
+        parser = RequestParser(**self.server.parser_limits)
+        tracer = self.server.tracer
+        self.command, self.path, self.requestline = None, '', ''
+        self.request_version = 'HTTP/1.0'
+        self.close_connection = 1
+        try:
+            try:
+                while not parser.complete:
+                    line = self.rfile.readline(parser.limit())
+                    if not line:
+                        return
+                    if tracer is not None and not parser.started():
+                        self.head_started = time.time()
+                    parser.feed(line)
+            except ParseError, e:
+                self.server.rejected += 1
+                self.send_error(e.status_code, str(e))
+                return
+
+            self.command, self.path = parser.method, parser.target
+            self.request_version = parser.protocol
+            self.requestline = '%s %s %s' % (self.command, self.path,
+                    self.request_version)
+            self.headers = parser.headers
+            connection = parser.headers.get('Connection', '').lower()
+            tokens = [token.strip() for token in connection.split(',')]
+            if self.request_version == 'HTTP/1.1':
+                self.close_connection = int('close' in tokens)
+            else:
+                self.close_connection = int('keep-alive' not in tokens)
+
+            method = getattr(self, 'do_' + self.command, None)
+            if method is None:
+                self.send_error(501, 'Unsupported method (%r)' % self.command)
+                return
+            self.server.request_started()
+            try:
+                method()
+                self.wfile.flush()
+            finally:
+                self.server.request_done()
+            if not self.server.running:
+                self.close_connection = 1
+        except socket.error:
+            # timed out, or reset by the client
+            self.close_connection = 1
 
     def do_GET(self):
         self.call_handler()
@@ -133,7 +248,7 @@ class WSGIHandler(BaseHTTPRequestHandler):
     def log_message(self, format, *args):
         pass
 
-    def send_error(self, code, message):
+    def send_error(self, code, message=None):
         url = urlparse(self.path)[2]
 
         if code == 404:
@@ -144,12 +259,16 @@ class WSGIHandler(BaseHTTPRequestHandler):
             'content': message,
             'versioninfo': '%s - Python %s' % (__version__, pyversion)
         }
+        body = ''
+        if self.command != 'HEAD' and code >= 200 and code not in (204, 304):
+            body = HTTP_ERROR_TEMPLATE % args
         self.send_response(code, message)
         self.send_header('Content-Type', 'text/html')
-        self.send_header('Connection', 'close')
+        self.send_header('Content-Length', str(len(body)))
+        if self.close_connection:
+            self.send_header('Connection', 'close')
         self.end_headers()
-        if self.command != 'HEAD' and code >= 200 and code not in (204, 304):
-            self.wfile.write(HTTP_ERROR_TEMPLATE % args)
+        self.wfile.write(body)
 
     def call_handler(self, skip_files=False):
         path_info, parameters, query = urlparse(self.path)[2:5]
@@ -194,22 +313,80 @@ class WSGIHandler(BaseHTTPRequestHandler):
                 mime_type = guessed_type[0]
             else:
                 mime_type = ';charset='.join(guessed_type)
-            self.send_response(200, 'OK')
-            self.send_header('Content-Type', mime_type)
-            self.end_headers()
-            for line in file(filename):
-                self.wfile.write(line)
+        encoding = None
+        if os.path.isfile(filename + '.gz'):
+            encoding = 'identity'
+            accept = self.headers.get('Accept-Encoding')
+            if accepts_encoding(accept, 'gzip'):
+                filename += '.gz'
+                encoding = 'gzip'
+        with open(filename, 'rb') as f:
+            length = os.fstat(f.fileno()).st_size
+            ranges = None
+            # no validators are sent, so If-Range can never match
+            if 'Range' in self.headers and 'If-Range' not in self.headers:
+                ranges = parse_range(self.headers['Range'], length)
+
+            if ranges == []:
+                self.send_response(416, 'Requested Range Not Satisfiable')
+                self.send_header('Content-Range', 'bytes */%d' % length)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if ranges:
+                self.send_response(206, 'Partial Content')
+            else:
+                self.send_response(200, 'OK')
+            if encoding is not None:
+                self.send_header('Vary', 'Accept-Encoding')
+            if encoding == 'gzip':
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Accept-Ranges', 'bytes')
+
+            if not ranges:
+                self.send_header('Content-Type', mime_type)
+                self.send_header('Content-Length', str(length))
+                self.end_headers()
+                self.wfile.flush()
+                send_file(self.connection, f, 0, length)
+            elif len(ranges) == 1:
+                start, stop = ranges[0]
+                self.send_header('Content-Type', mime_type)
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (start,
+                    stop - 1, length))
+                self.send_header('Content-Length', str(stop - start))
+                self.end_headers()
+                self.wfile.flush()
+                send_file(self.connection, f, start, stop - start)
+            else:
+                boundary, total, parts, trailer = byteranges(ranges, length,
+                        mime_type)
+                self.send_header('Content-Type',
+                        'multipart/byteranges; boundary=%s' % boundary)
+                self.send_header('Content-Length', str(total))
+                self.end_headers()
+                for headers, start, stop in parts:
+                    self.wfile.write(headers)
+                    self.wfile.flush()
+                    send_file(self.connection, f, start, stop - start)
+                self.wfile.write(trailer)
 
 
     def run_application(self, app, path_info, script_name, query):
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = 0
+        stdin = LimitedInput(self.rfile, length)
         environ = {
             'wsgi.version':         (1,0),
             'wsgi.url_scheme':      'http',
-            'wsgi.input':           self.rfile,
+            'wsgi.input':           stdin,
             'wsgi.errors':          sys.stderr,
             'wsgi.multithread':     1,
             'wsgi.multiprocess':    0,
             'wsgi.run_once':        0,
+            'wsgi.file_wrapper':    FileWrapper,
             'trabant.stop':         self.server.stop,
             'REQUEST_METHOD':       self.command,
             'SCRIPT_NAME':          script_name,
@@ -239,8 +416,17 @@ class WSGIHandler(BaseHTTPRequestHandler):
                 status, response_headers = headers_sent[:] = headers_set
                 code, msg = status.split(' ', 1)
                 self.send_response(int(code), msg)
+                names = set()
                 for line in response_headers:
+                    names.add(line[0].lower())
                     self.send_header(*line)
+                if 'content-length' not in names and code not in ('204', '304'):
+                    # no way to delimit the body but closing
+                    self.close_connection = 1
+                if self.close_connection:
+                    self.send_header('Connection', 'close')
+                elif self.request_version == 'HTTP/1.0':
+                    self.send_header('Connection', 'keep-alive')
                 self.end_headers()
 
             self.wfile.write(data)
@@ -258,40 +444,283 @@ class WSGIHandler(BaseHTTPRequestHandler):
             headers_set[:] = [status, response_headers]
             return write
 
-        result = app(environ, start_response)
+        tracer = self.server.tracer
+        if tracer is None:
+            result = app(environ, start_response)
+        else:
+            trace = tracer.begin(environ, self.head_started)
+            result = tracer.call(app, environ, start_response)
+        length = None
+        if isinstance(result, FileWrapper):
+            length = result.length
+        elif isinstance(result, list) and len(result) == 1:
+            length = len(result[0])
+        if length is not None and headers_set and \
+                headers_set[0][:3] not in ('204', '304'):
+            names = [name.lower() for name, value in headers_set[1]]
+            if 'content-length' not in names:
+                headers_set[1] = list(headers_set[1]) + [
+                        ('Content-Length', str(length))]
         try:
             try:
-                for data in result:
-                    write(data)
+                if isinstance(result, FileWrapper) and length is not None:
+                    write('')
+                    self.wfile.flush()
+                    send_file(self.connection, result.filelike,
+                            result.filelike.tell(), length)
+                else:
+                    for data in result:
+                        write(data)
+                if not headers_sent:
+                    write('')
+                if tracer is not None:
+                    tracer.finish(trace)
             finally:
                 if hasattr(result, 'close'):
                     result.close()
+            stdin.drain()
         except (socket.error, socket.timeout):
+            self.close_connection = 1
             return # "there was no error" ^^
 
 
 class WSGIServer(HTTPServer):
 
-    def __init__(self, app, hostname='localhost', port=8080, files={}):
-        HTTPServer.__init__(self, (hostname, port), WSGIHandler)
+    # how often `run` wakes up to notice `stop`
+    timeout = 1.0
+    request_queue_size = 128
+
+    def __init__(self, app, hostname='localhost', port=8080, files={},
+            keep_alive_timeout=15, parser_limits=None, sock=None,
+            metrics=None, tracer=None):
+        HTTPServer.__init__(self, (hostname, port), WSGIHandler,
+                sock is None)
+        if sock is not None:
+            # already listening, e.g. shared by the workers of a `Master`
+            self.socket.close()
+            self.socket = sock
+            self.server_address = sock.getsockname()
+        self.keep_alive_timeout = keep_alive_timeout
+        # max_request_line, max_header_bytes, max_headers, see RequestParser
+        self.parser_limits = parser_limits or {}
         if isinstance(app, dict):
             self.applications = app
         else:
             self.applications = {'/': app}
         self.files = files
         self.running = True
+        self.served = 0
+        # stop after serving this many requests, see `Master`
+        self.recycle_after = None
+        self.connections = 0
+        self.active = 0 # connections handling a request
+        self.rejected = 0
+        self.tracer = tracer # see `trabant.tracing`
+        self.lock = threading.Lock()
+        self.name = '%s:%d' % self.socket.getsockname()[:2]
+        if metrics is not None:
+            # see `trabant.metrics`
+            metrics.add_collector(self)
 
     def run(self):
         while self.running:
             self.handle_request()
+        # let the connections being served finish their request
+        deadline = time.time() + self.keep_alive_timeout
+        while self.connections and time.time() < deadline:
+            time.sleep(0.05)
 
     def stop(self):
         self.running = False
 
+    def verify_request(self, request, client_address):
+        # counted as soon as accepted, before a thread picks it up
+        with self.lock:
+            self.connections += 1
+        return True
+
+    def shutdown_request(self, request):
+        HTTPServer.shutdown_request(self, request)
+        with self.lock:
+            self.connections -= 1
+
+    def request_started(self):
+        with self.lock:
+            self.active += 1
+
+    def request_done(self):
+        with self.lock:
+            self.active -= 1
+            self.served += 1
+            served = self.served
+        if self.recycle_after and served >= self.recycle_after:
+            self.stop()
+
+    def collect(self):
+        """Samples for a metrics `Registry`."""
+        labels = {'server': self.name}
+        active = self.active
+        yield ('trabant_connections', 'gauge', 'Open connections',
+                dict(labels, phase='handling'), active)
+        yield ('trabant_connections', 'gauge', 'Open connections',
+                dict(labels, phase='idle'), max(0, self.connections - active))
+        yield ('trabant_requests_served_total', 'counter', 'Requests served',
+                labels, self.served)
+        yield ('trabant_requests_rejected_total', 'counter',
+                'Malformed requests, and connections over capacity, '
+                'answered with an error', labels,
+                self.rejected)
+
+    def park(self, handler):
+        """Whether to let go of the connection of `handler` while it waits
+        for its next request."""
+        return False
+
     def serve_forever(self):
         raise NotImplementedError
 
 
-class ThreadedWSGIServer(ThreadingMixIn, WSGIServer):
-    pass
+SERVICE_UNAVAILABLE = ('HTTP/1.1 503 Service Unavailable\r\n'
+        'Content-Length: 0\r\nConnection: close\r\n\r\n')
+
+class _IdleConnection(object):
+    """A keep-alive connection waiting for its next request in the idle
+    loop of a `PoolMixIn`, queued for the workers again once it comes."""
+
+    def __init__(self, server, request, client_address):
+        self.server = server
+        self.request = request
+        self.client_address = client_address
+        self.fd = request.fileno()
+        self.loop = server.idle_loop
+        self.loop.register(self.fd, self, EVENT_READ)
+        self.loop.wheel.schedule(self,
+                time.time() + server.keep_alive_timeout)
+
+    def release(self):
+        self.loop.unregister(self.fd)
+        self.loop.wheel.schedule(self, None)
+
+    def handle_read(self):
+        self.release()
+        try:
+            closed = not self.request.recv(1, socket.MSG_PEEK)
+        except socket.error:
+            closed = True
+        if closed:
+            self.server.shutdown_request(self.request)
+        else:
+            PoolMixIn.process_request(self.server, self.request,
+                    self.client_address)
+
+    def handle_timeout(self):
+        self.release()
+        self.server.shutdown_request(self.request)
+
+    def handle_error(self):
+        traceback.print_exc()
+        self.handle_timeout()
+
+    def handle_write(self):
+        pass
+
+    def update_events(self):
+        pass
+
+
+class PoolMixIn:
+    """Handle requests with a fixed set of worker threads, fed through a
+    queue of at most `queue_size` accepted connections. When the queue is
+    full, `overflow` decides whether new connections are answered with a
+    503 (`'reject'`) or wait for room in the queue (`'block'`).
+
+    Between requests keep-alive connections don't hold a worker, they wait
+    in an event loop of their own (for `keep_alive_timeout` seconds at
+    most) and are queued again when their next request comes."""
+
+    daemon_threads = True
+
+    def start_workers(self, pool_size, queue_size, overflow):
+        if overflow not in ('reject', 'block'):
+            raise ValueError('overflow must be `reject` or `block`')
+        self.overflow = overflow
+        self.requests = Queue(queue_size)
+        self.idle_loop = EventLoop()
+        self.idle_loop.add_waker()
+        watcher = threading.Thread(target=self.watch_idle)
+        watcher.daemon = True
+        watcher.start()
+        self.workers = []
+        for i in range(pool_size):
+            worker = threading.Thread(target=self.process_requests)
+            worker.daemon = self.daemon_threads
+            worker.start()
+            self.workers.append(worker)
+
+    def process_requests(self):
+        while True:
+            request, client_address = self.requests.get()
+            handler = None
+            try:
+                handler = self.RequestHandlerClass(request, client_address,
+                        self)
+            except:
+                self.handle_error(request, client_address)
+            if handler is not None and handler.parked and self.running:
+                self.idle_loop.call_soon_threadsafe(_IdleConnection, self,
+                        request, client_address)
+            else:
+                self.shutdown_request(request)
+
+    def park(self, handler):
+        # pipelined input already buffered by the handler would be lost
+        return not handler.rfile._rbuf.getvalue()
+
+    def watch_idle(self):
+        loop = self.idle_loop
+        while self.running:
+            loop.run_once(1.0)
+        for handler in loop.handlers.values():
+            if isinstance(handler, _IdleConnection):
+                handler.handle_timeout()
+
+    def process_request(self, request, client_address):
+        try:
+            self.requests.put((request, client_address),
+                    self.overflow == 'block')
+        except Full:
+            self.rejected += 1
+            try:
+                request.sendall(SERVICE_UNAVAILABLE)
+            except socket.error:
+                pass
+            self.shutdown_request(request)
+
+
+class ThreadedWSGIServer(ThreadingMixIn, PoolMixIn, WSGIServer):
+    """Thread per connection by default, pass `pool_size` to use a fixed
+    pool of workers instead (see `PoolMixIn`)."""
+
+    daemon_threads = True
+
+    def __init__(self, app, hostname='localhost', port=8080, files={},
+            keep_alive_timeout=15, pool_size=None, queue_size=64,
+            overflow='reject', parser_limits=None, sock=None, metrics=None,
+            tracer=None):
+        WSGIServer.__init__(self, app, hostname, port, files,
+                keep_alive_timeout, parser_limits, sock, metrics, tracer)
+        self.pool_size = pool_size
+        if pool_size:
+            self.start_workers(pool_size, queue_size, overflow)
+
+    def process_request(self, request, client_address):
+        if self.pool_size:
+            PoolMixIn.process_request(self, request, client_address)
+        else:
+            ThreadingMixIn.process_request(self, request, client_address)
+
+    def park(self, handler):
+        if self.pool_size:
+            return PoolMixIn.park(self, handler)
+        return WSGIServer.park(self, handler)
 
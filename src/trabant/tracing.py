@@ -0,0 +1,178 @@
+"""Per-request phase tracing and on-demand profiling.
+
+A server given a `Tracer` (its `tracer` argument) puts a `Trace` in the
+environ of each request, as `trabant.trace`, and timestamps its phases:
+`headers` (from the first byte to the end of the head), `body` (async server
+only), `app` (what the application took beyond its own phases) and `write`
+(until the response is written out, including lazily produced bodies).
+`App` adds `routing` and `handler`, and nested in the handler `params`,
+`compile` and `render` are recorded when the parameters are parsed and a
+`Renderer` compiles or renders a template.
+
+    def log_slow(trace):
+        logging.warning('slow request: %s', trace)
+
+    tracer = Tracer(log_slow, threshold=0.5, profile_token='s3cret')
+    HTTPServer(app, 'localhost', 8080, tracer=tracer)
+
+The hook is called with every trace of at least `threshold` seconds. A
+request with an `X-Trabant-Profile: s3cret` header runs under cProfile, and
+so does the next one after `tracer.profile_next()`: the stats are saved in
+`profile_dir` (see `pstats`), the trace's `profile` is their path and it's
+passed to the hook whatever its duration. Only the application call is
+profiled, not the consumption of a lazy body.
+
+Without a tracer none of this runs: a request costs the servers a `None`
+check and `App` a dict lookup, templates and parameters a flag check.
+"""
+
+import os
+import re
+import sys
+import hmac
+import time
+import cProfile
+import threading
+import traceback
+
+PROFILE_HEADER = 'HTTP_X_TRABANT_PROFILE'
+
+# whether a `Tracer` was ever made, checked before looking for the current
+# trace
+enabled = False
+
+_local = threading.local()
+
+
+class Trace(object):
+    """Timestamps of the phases of a request.
+
+    `phases` lists `(name, start, end)` in the order the phases ended.
+    Phases ended with `mark` follow each other from `start`, the ones
+    recorded with `add` are nested in them (e.g. rendering, in the handler).
+    """
+
+    def __init__(self, environ, start=None):
+        self.environ = environ
+        self.start = self.last = start or time.time()
+        self.phases = []
+        self.profile = None # path of the profile stats, if profiled
+
+    def mark(self, name):
+        """End phase `name`, that started when the previous one ended."""
+        now = time.time()
+        self.phases.append((name, self.last, now))
+        self.last = now
+
+    def add(self, name, start, end=None):
+        """Record a phase nested in the current one."""
+        self.phases.append((name, start, end or time.time()))
+
+    @property
+    def duration(self):
+        return self.last - self.start
+
+    def __str__(self):
+        environ = self.environ
+        return '%s %s %.1fms: %s%s' % (environ.get('REQUEST_METHOD'),
+                environ.get('PATH_INFO'), self.duration * 1000,
+                ', '.join('%s %.1fms' % (name, (end - start) * 1000)
+                    for name, start, end in self.phases),
+                self.profile and ' (profile: %s)' % self.profile or '')
+
+
+def current():
+    """The trace of the request the current thread is running the
+    application for, if traced."""
+    return getattr(_local, 'trace', None)
+
+def timed(name, func):
+    """Call `func`, recording how long it took as phase `name` of the
+    current trace, if any."""
+    trace = current()
+    if trace is None:
+        return func()
+    started = time.time()
+    try:
+        return func()
+    finally:
+        trace.add(name, started)
+
+
+class Tracer(object):
+
+    def __init__(self, hook=None, threshold=1.0, profile_token=None,
+            profile_dir='.'):
+        global enabled
+        enabled = True
+        self.hook = hook
+        self.threshold = threshold
+        self.profile_token = profile_token
+        self.profile_dir = profile_dir
+        self.profile_count = 0
+
+    def profile_next(self, count=1):
+        """Profile the next `count` requests, whatever their headers."""
+        self.profile_count += count
+
+    def begin(self, environ, start):
+        """Trace the request of `environ`, whose head started arriving at
+        `start` and was just parsed."""
+        trace = environ['trabant.trace'] = Trace(environ, start)
+        trace.mark('headers')
+        return trace
+
+    def call(self, app, environ, start_response):
+        """Run `app`, under cProfile if the request asks for it."""
+        trace = environ['trabant.trace']
+        _local.trace = trace
+        try:
+            if self.wants_profile(environ):
+                result = self.profile(trace, app, environ, start_response)
+            else:
+                result = app(environ, start_response)
+        finally:
+            _local.trace = None
+        trace.mark('app')
+        return result
+
+    def wants_profile(self, environ):
+        if self.profile_count > 0:
+            self.profile_count -= 1
+            return True
+        token = environ.get(PROFILE_HEADER)
+        return token is not None and self.profile_token is not None and \
+                hmac.compare_digest(token, self.profile_token)
+
+    def profile(self, trace, app, environ, start_response):
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(app, environ, start_response)
+        finally:
+            if not os.path.isdir(self.profile_dir):
+                os.makedirs(self.profile_dir)
+            name = re.sub(r'[^A-Za-z0-9]+', '_',
+                    environ.get('PATH_INFO', '')).strip('_')[:64]
+            now = time.time()
+            trace.profile = os.path.join(self.profile_dir,
+                    '%s.%03d-%d-%s.prof' % (time.strftime('%Y%m%d-%H%M%S',
+                        time.localtime(now)), now % 1 * 1000, os.getpid(),
+                        name or 'root'))
+            profiler.dump_stats(trace.profile)
+
+    def finish(self, trace):
+        """End the trace once the response is written, and pass it to the
+        hook if slow or profiled."""
+        trace.mark('write')
+        if self.hook is None:
+            return
+        if trace.duration >= self.threshold or trace.profile:
+            try:
+                self.hook(trace)
+            except Exception:
+                traceback.print_exc()
+
+
+def log_slow(trace):
+    """A hook writing traces to stderr."""
+    sys.stderr.write('slow request: %s\n' % trace)
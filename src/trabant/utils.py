@@ -1,13 +1,68 @@
+import calendar
+from email.utils import parsedate
+
+
+class MultiDict(dict):
+    """A dict of the last value given for each name, all of them are
+    available with `getall`."""
+
+    def __init__(self):
+        dict.__init__(self)
+        self.lists = {}
+
+    def add(self, name, value):
+        self.lists.setdefault(name, []).append(value)
+        dict.__setitem__(self, name, value)
+
+    def __setitem__(self, name, value):
+        self.lists[name] = [value]
+        dict.__setitem__(self, name, value)
+
+    def __delitem__(self, name):
+        del self.lists[name]
+        dict.__delitem__(self, name)
+
+    def getall(self, name):
+        return self.lists.get(name, [])
+
+    def update(self, other):
+        if isinstance(other, MultiDict):
+            for name, values in other.lists.iteritems():
+                for value in values:
+                    self.add(name, value)
+        else:
+            for name, value in dict(other).iteritems():
+                self.add(name, value)
+
+
+class cached_property(object):
+    """Property computed on first access, then stored on the instance."""
+
+    def __init__(self, func):
+        self.func = func
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, type=None):
+        if obj is None:
+            return self
+        value = obj.__dict__[self.__name__] = self.func(obj)
+        return value
+
+
 def parse_params(query):
-    r = {}
+    """Parse a query string into a `MultiDict`, names without a value are
+    set to `True`."""
+    r = MultiDict()
     if query:
-        for param in filter(bool, (query.split('&'))):
-            print param
+        for param in query.split('&'):
+            if not param:
+                continue
             if '=' not in param:
-                r[unquote(param)] = True
+                r.add(unquote_plus(param), True)
             else:
                 var, val = param.split('=', 1)
-                r[unquote(var)] = unquote(val)
+                r.add(unquote_plus(var), unquote_plus(val))
     return r
 
 
@@ -100,3 +155,84 @@ def quote_plus(s, safe = ''):
         return s.replace(' ', '+')
     return quote(s, safe)
 
+def httpdate(dt):
+    """Return a string representation of a date according to RFC 1123
+    (HTTP/1.1).
+
+    The supplied date must be in UTC.
+
+    """
+    weekday = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'][dt.weekday()]
+    month = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep',
+             'Oct', 'Nov', 'Dec'][dt.month - 1]
+    return '%s, %02d %s %04d %02d:%02d:%02d GMT' % (weekday, dt.day, month,
+        dt.year, dt.hour, dt.minute, dt.second)
+
+def parse_httpdate(value):
+    """Return the timestamp of an HTTP date, or `None` if it's invalid."""
+    parsed = parsedate(value)
+    if parsed is None:
+        return None
+    try:
+        return calendar.timegm(parsed)
+    except (ValueError, OverflowError):
+        return None
+
+def accepts_encoding(accept_encoding, encoding):
+    """Check if an `Accept-Encoding` header allows `encoding` (with a
+    non-zero q)."""
+    for item in (accept_encoding or '').split(','):
+        params = item.split(';')
+        if params[0].strip().lower() not in (encoding, '*'):
+            continue
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+# more ranges than this in a request are ignored, and the whole entity sent
+MAX_RANGES = 16
+
+def parse_range(value, length):
+    """Parse a `Range` header for an entity of `length` bytes.
+
+    Return a list of `(start, stop)` pairs, empty if none of them is
+    satisfiable, or `None` if the header is invalid and must be ignored.
+    """
+    unit, _, spec = value.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    items = [item.strip() for item in spec.split(',') if item.strip()]
+    if not items or len(items) > MAX_RANGES:
+        return None
+    ranges = []
+    for item in items:
+        first, sep, last = item.partition('-')
+        if not sep:
+            return None
+        try:
+            if not first.strip():
+                suffix = int(last)
+                if suffix < 0:
+                    return None
+                if suffix == 0:
+                    continue
+                ranges.append((max(length - suffix, 0), length))
+                continue
+            start = int(first)
+            if last.strip():
+                stop = int(last) + 1
+            else:
+                stop = max(length, start + 1)
+        except ValueError:
+            return None
+        if start < 0 or stop <= start:
+            return None
+        if start < length:
+            ranges.append((start, min(stop, length)))
+    return ranges
@@ -1,40 +1,183 @@
 import re
 import os
-import cgi
+import sys
+import stat
+import time
+import calendar
+import zlib
+import hashlib
 import mimetypes
+import threading
+import sre_parse
 import traceback
+from datetime import datetime
+from collections import OrderedDict, MutableMapping
+from Cookie import SimpleCookie, CookieError
 from trabant import utils
-try:
-    from resources import opener
-except ImportError:
-    import warnings
-    warnings.warn("Unable to load module `resources`, Trabant will be "
-            "unable to load static resources contained in zip file")
-    opener = open
+from trabant.filewrapper import FileWrapper, byteranges, iter_byteranges
+from trabant import resources
+from trabant import metrics as _metrics
+from trabant import tracing as _tracing
+from trabant.forms import parse_form, FormError
+from trabant.httpparser import Headers
 
 
 STATUS_CODES = {
     200: 'OK',
+    206: 'Partial Content',
     302: 'Found',
     304: 'Not Modified',
+    400: 'Bad Request',
     404: 'Not Found',
+    413: 'Request Entity Too Large',
+    416: 'Requested Range Not Satisfiable',
     418: 'I\'m a teapot',
     500: 'Internal Server Error',
 }
 
 class HTTPError(Exception):
-    def __init__(self, status_code):
+    def __init__(self, status_code, headers=None):
         self.status_code = status_code
+        self.headers = headers
 
 class HTTPRedirect(HTTPError):
     def __init__(self, status_code, location):
         self.status_code = status_code
         self.location = location
 
-def serve_static(base='', module=None):
+class ValidatorCache(object):
+    """Small LRU cache of the validators of static files, so conditional
+    requests are answered without touching the file. Files are stat'ed
+    again at most every `interval` seconds."""
+
+    def __init__(self, size=256, interval=1):
+        self.size = size
+        self.interval = interval
+        self._entries = OrderedDict() # path -> (checked, validators)
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """Return `(etag, last_modified, mtime, size)` for the file at
+        `path`, or `None` if it's not a regular file."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is not None and now - entry[0] < self.interval:
+                self._entries[path] = entry
+                return entry[1]
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            validators = None
+        else:
+            if not stat.S_ISREG(st.st_mode):
+                validators = None
+            else:
+                mtime = int(st.st_mtime)
+                validators = ('"%x-%x"' % (mtime, st.st_size),
+                        utils.httpdate(datetime.utcfromtimestamp(mtime)), mtime,
+                        st.st_size)
+        with self._lock:
+            self._entries[path] = (now, validators)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return validators
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+validator_cache = ValidatorCache()
+
+def not_modified(environ, etag, mtime):
+    """Check the request preconditions, `If-None-Match` wins over
+    `If-Modified-Since` when both are present."""
+    if 'HTTP_IF_NONE_MATCH' in environ:
+        tags = [tag.strip() for tag in environ['HTTP_IF_NONE_MATCH'].split(',')]
+        return '*' in tags or etag in tags or 'W/' + etag in tags
+    if 'HTTP_IF_MODIFIED_SINCE' in environ:
+        since = utils.parse_httpdate(environ['HTTP_IF_MODIFIED_SINCE'])
+        return since is not None and mtime <= since
+    return False
+
+def member_validators(member):
+    """Validators of a zip archive member, like `ValidatorCache.get`."""
+    if member is None:
+        return None
+    mtime = calendar.timegm(member.mtime.timetuple())
+    return ('"%08x-%x"' % (member.crc, member.size),
+            utils.httpdate(member.mtime), mtime, member.size)
+
+def requested_ranges(environ, etag, last_modified, length):
+    """Return the byte ranges the request asks for (see `parse_range`), or
+    `None` when the whole entity must be sent."""
+    if 'HTTP_RANGE' not in environ or environ['REQUEST_METHOD'] != 'GET':
+        return None
+    if_range = environ.get('HTTP_IF_RANGE')
+    if if_range is not None and if_range.strip() not in (etag, last_modified):
+        return None
+    return utils.parse_range(environ['HTTP_RANGE'], length)
+
+def serve_static(base='', module=None, max_age=None, immutable=False,
+        cache=validator_cache, precompressed=True):
+    """Serve the files under `base`, with `ETag` and `Last-Modified`
+    validators. `max_age` and `immutable` set the `Cache-Control` policy of
+    the mount. With `precompressed`, a `.gz` sibling of the file is served
+    instead to clients accepting gzip. Single and multiple byte ranges are
+    supported. Files are looked up in `module`'s zip archive if given (see
+    `trabant.resources`)."""
+    cache_control = []
+    if max_age is not None:
+        cache_control.append('max-age=%d' % max_age)
+    if immutable:
+        cache_control.append('immutable')
+    cache_control = ', '.join(cache_control)
+
     def _serve_static(environ, path):
-        if 'HTTP_IF_MODIFIED_SINCE' in environ:
-            raise HTTPError(304)
+        headers = []
+        ranges = None
+        if cache_control:
+            headers.append(('Cache-Control', cache_control))
+        if module:
+            # archive names, nothing to resolve on disk
+            root = os.path.normpath(base)
+            filename = os.path.normpath(os.path.join(root, path))
+        else:
+            root = os.path.realpath(base)
+            filename = os.path.realpath(os.path.join(root, path))
+        relative = os.path.relpath(filename, root)
+        if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+            raise HTTPError(404)
+        archive = None
+        if module:
+            archive, filename = resources.locate(filename, module)
+        if archive is not None:
+            validate = lambda name: member_validators(archive.info(name))
+        else:
+            validate = cache.get
+
+        validators = validate(filename)
+        if validators is None:
+            raise HTTPError(404)
+        if precompressed:
+            gz_validators = validate(filename + '.gz')
+            if gz_validators is not None:
+                headers.append(('Vary', 'Accept-Encoding'))
+                accept = environ.get('HTTP_ACCEPT_ENCODING')
+                if utils.accepts_encoding(accept, 'gzip'):
+                    filename += '.gz'
+                    validators = gz_validators
+                    headers.append(('Content-Encoding', 'gzip'))
+        etag, last_modified, mtime, size = validators
+        headers.extend([('ETag', etag), ('Last-Modified', last_modified)])
+        if not_modified(environ, etag, mtime):
+            raise HTTPError(304, headers)
+        headers.append(('Accept-Ranges', 'bytes'))
+        ranges = requested_ranges(environ, etag, last_modified, size)
+        if ranges == []:
+            raise HTTPError(416, headers + [
+                ('Content-Range', 'bytes */%d' % size)])
 
         guessed_type = mimetypes.guess_type(path)
         if guessed_type[0] is None:
@@ -47,49 +190,292 @@ def serve_static(base='', module=None):
             else:
                 mime_type = ';charset='.join(guessed_type)
 
-        if module:
-            f = opener(os.path.join(base, path), 'r', module=module)
-        else:
-            f = opener(os.path.join(base, path), 'r')
+        try:
+            if archive is not None:
+                f = archive.open(filename)
+            else:
+                f = open(filename, 'r')
+        except IOError:
+            raise HTTPError(404)
 
-        #if not abspath.startswith('.'):
-        #    raise HTTPError(404)
+        if ranges and len(ranges) == 1:
+            start, stop = ranges[0]
+            f.seek(start)
+            headers.extend([('Content-Type', mime_type), ('Content-Range',
+                'bytes %d-%d/%d' % (start, stop - 1, size))])
+            return '206 Partial Content', headers, FileWrapper(f,
+                    length=stop - start)
+        elif ranges:
+            boundary, length, parts, trailer = byteranges(ranges, size,
+                    mime_type)
+            headers.extend([
+                ('Content-Type', 'multipart/byteranges; boundary=%s' % boundary),
+                ('Content-Length', str(length))])
+            return '206 Partial Content', headers, iter_byteranges(f, parts,
+                    trailer)
 
+        headers.append(('Content-Type', mime_type))
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None:
+            return headers, file_wrapper(f)
         try:
-            return [ ('Content-Type', mime_type),
-                    # %a, %d %b %Y %H:%M:%S
-                    ('Last-Modified', 'Tue, 17 Apr 2012 00:00:00') ], f.read()
+            return headers, f.read()
         except IOError:
             raise HTTPError(404)
+        finally:
+            f.close()
     return _serve_static
 
 def redirect(environ, location):
     raise HTTPRedirect(302, location)
 
 
-class App(object):
+_named_group = re.compile(r'(?<!\\)\(\?P<([a-zA-Z_]\w*)>')
+# constructs that cannot be safely merged in a single alternation
+_standalone = re.compile(r'\(\?P=|\(\?\(|\(\?[iLmsux]+\)|\\[1-9]')
+# sre has a hard limit on the number of groups in a pattern
+MAX_GROUPS = 99
+_ANCHORS = ((sre_parse.AT, sre_parse.AT_BEGINNING),
+        (sre_parse.AT, sre_parse.AT_BEGINNING_STRING))
+
+class Router(object):
+    """Compile a set of routes once, and dispatch a path in a single pass.
+
+    `routes` is a dict or a sequence of `(pattern, func)` pairs, patterns
+    are tried in declaration order (use a list or an `OrderedDict` if the
+    order matters).  Consecutive anchored patterns (`^...`, the anchor
+    covering the whole pattern, so not `^/a|/b`) are merged in one
+    alternation, every route wrapped in its own group so the route that
+    matched is given by `lastindex`.  Other patterns are matched one by one
+    with `re.search`, as before.
+    """
 
     def __init__(self, routes):
+        if hasattr(routes, 'items'):
+            routes = routes.items()
+        self.routes = list(routes)
+        self.chunks = []
+
+        pending, groups = [], 0
+        for pattern, func in self.routes:
+            parsed = sre_parse.parse(pattern)
+            ngroups = parsed.pattern.groups
+            # a top level alternation starts with a branch, unless all its
+            # alternatives are anchored
+            mergeable = (len(parsed) and parsed[0] in _ANCHORS and
+                    not _standalone.search(pattern) and ngroups < MAX_GROUPS)
+            if not mergeable or groups + ngroups > MAX_GROUPS:
+                self._flush(pending)
+                pending, groups = [], 0
+            if mergeable:
+                pending.append((pattern, func))
+                groups += ngroups
+            else:
+                regex = re.compile(pattern)
+                self.chunks.append((regex.search, {None: (func, None)}))
+        self._flush(pending)
+
+    def _flush(self, pending):
+        if not pending:
+            return
+        parts, names = [], []
+        for i, (pattern, func) in enumerate(pending):
+            names.append(_named_group.findall(pattern))
+            parts.append('(?P<_r%d>%s)' % (i, _named_group.sub(
+                lambda m: '(?P<_r%d_%s>' % (i, m.group(1)), pattern)))
+        regex = re.compile('|'.join(parts))
+        index = regex.groupindex
+        table = {}
+        for i, (pattern, func) in enumerate(pending):
+            table[index['_r%d' % i]] = (func, [(name, index['_r%d_%s' % (i, name)])
+                for name in names[i]])
+        self.chunks.append((regex.match, table))
+
+    def match(self, path):
+        """Return `(func, kwargs)` for the first route matching `path`, or
+        `(None, None)`."""
+        for match, table in self.chunks:
+            m = match(path)
+            if m is None:
+                continue
+            if None in table:
+                return table[None][0], m.groupdict()
+            func, groups = table[m.lastindex]
+            return func, dict((name, m.group(i)) for name, i in groups)
+        return None, None
+
+
+class Request(object):
+    """Lazy view of a request: the query string, form, cookies and headers
+    are parsed on first access, then cached. Handlers find it in
+    `environ['trabant.request']`."""
+
+    def __init__(self, environ):
+        self.environ = environ
+        self.method = environ['REQUEST_METHOD']
+        self.path = environ['PATH_INFO']
+
+    @utils.cached_property
+    def query(self):
+        return utils.parse_params(self.environ.get('QUERY_STRING'))
+
+    @utils.cached_property
+    def form(self):
+        if self.method not in ('POST', 'PUT', 'PATCH'):
+            return utils.MultiDict()
+        try:
+            return parse_form(self.environ)
+        except FormError, e:
+            raise HTTPError(e.status_code)
+
+    @utils.cached_property
+    def params(self):
+        """Query and form params together, the form's win."""
+        params = utils.MultiDict()
+        params.update(self.query)
+        params.update(self.form)
+        return params
+
+    @utils.cached_property
+    def cookies(self):
+        cookies = {}
+        try:
+            for name, morsel in SimpleCookie(
+                    self.environ.get('HTTP_COOKIE', '')).iteritems():
+                cookies[name] = morsel.value
+        except CookieError:
+            pass
+        return cookies
+
+    @utils.cached_property
+    def headers(self):
+        headers = Headers()
+        for key, value in self.environ.iteritems():
+            if key.startswith('HTTP_'):
+                key = key[5:]
+            elif key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                continue
+            headers.add(key.replace('_', '-').title(), value)
+        return headers
+
+
+class LazyParams(MutableMapping):
+    """`environ['trabant.params']`, the `params` of a `Request` parsed the
+    first time they're looked at. Not a `dict`, whose C-level accessors
+    (`dict(params)`, `f(**params)`) would see it empty before that."""
+
+    def __init__(self, request):
+        self.request = request
+
+    @utils.cached_property
+    def params(self):
+        params = utils.MultiDict()
+        if _tracing.enabled:
+            _tracing.timed('params',
+                    lambda: params.update(self.request.params))
+        else:
+            params.update(self.request.params)
+        return params
+
+    @property
+    def loaded(self):
+        return 'params' in self.__dict__
+
+    def __getitem__(self, name):
+        return self.params[name]
+
+    def __setitem__(self, name, value):
+        self.params[name] = value
+
+    def __delitem__(self, name):
+        del self.params[name]
+
+    def __contains__(self, name):
+        return name in self.params
+
+    def __iter__(self):
+        return iter(self.params)
+
+    def __len__(self):
+        return len(self.params)
+
+    def __repr__(self):
+        return repr(self.params)
+
+    def getall(self, name):
+        return self.params.getall(name)
+
+    def add(self, name, value):
+        self.params.add(name, value)
+
+    def copy(self):
+        params = utils.MultiDict()
+        params.update(self.params)
+        return params
+
+
+class App(object):
+    """Dispatch requests to the function of the first route matching their
+    path.
+
+    With a `metrics` registry (see `trabant.metrics`), requests are counted
+    by route and status, and their latency is recorded per route. `stats`
+    serves the registry on `/_trabant/stats`.
+    """
+
+    def __init__(self, routes, metrics=None, stats=False):
         self.routes = routes
+        if stats:
+            if hasattr(routes, 'items'):
+                routes = routes.items()
+            routes = [('^%s$' % re.escape(_metrics.STATS_PATH),
+                _metrics.stats_handler(metrics or _metrics.registry))] + \
+                        list(routes)
+        self.router = Router(routes)
+        self.metrics = metrics
+        if metrics is not None:
+            self.route_names = {}
+            for pattern, func in (routes.items() if hasattr(routes, 'items')
+                    else routes):
+                self.route_names.setdefault(func, pattern)
+            self.requests = metrics.counter('trabant_requests_total',
+                    'Requests handled by App', ('route', 'status'))
+            self.latency = metrics.histogram(
+                    'trabant_request_duration_seconds',
+                    'Time App took to handle requests', ('route',))
+            self.recorders = {} # (func, status) -> (counter, histogram)
+
+    def record(self, func, status, duration):
+        key = (func, status[:3])
+        recorder = self.recorders.get(key)
+        if recorder is None:
+            route = self.route_names.get(func, 'unmatched')
+            recorder = self.recorders[key] = (
+                    self.requests.labels(route, key[1]),
+                    self.latency.labels(route))
+        recorder[0].value += 1
+        recorder[1].observe(duration)
 
     def __call__(self, environ, start_response):
+        if self.metrics is not None:
+            started = time.time()
+        trace = environ.get('trabant.trace')
         status = '200 OK'
-        for pattern, func in self.routes.items():
-            match = re.search(pattern, environ['PATH_INFO'])
-            if match:
-                break
+        func, kwargs = self.router.match(environ['PATH_INFO'])
+        if trace is not None:
+            trace.mark('routing')
         headers = [('Content-type', 'text/html')]
         body = ''
         try:
-            if not match:
+            if func is None:
                 raise HTTPError(404)
 
-            environ['trabant.params'] = utils.parse_params(environ['QUERY_STRING'])
-            if environ['REQUEST_METHOD'] == 'POST':
-                moar = cgi.parse(environ['wsgi.input'], environ)
-                environ['trabant.params'].update(moar)
-            result = func(environ, **match.groupdict())
-            if isinstance(result, tuple):
+            request = environ['trabant.request'] = Request(environ)
+            environ['trabant.params'] = LazyParams(request)
+            result = func(environ, **kwargs)
+            if isinstance(result, tuple) and len(result) == 3:
+                status, headers, body = result
+            elif isinstance(result, tuple):
                 headers, body = result
             else:
                 body = result
@@ -101,13 +487,252 @@ class App(object):
 
         except HTTPError, e:
             status = '%d %s' % (e.status_code, STATUS_CODES[e.status_code])
-            body = status
+            if e.headers is not None:
+                headers = e.headers
+            if e.status_code == 304:
+                body = ''
+            else:
+                body = status
 
         except Exception, e:
             status = '500 Server Error'
             body = '<h1>Ouch... Internal Server Error</h1>\n<pre>%s</pre>' % traceback.format_exc()
 
+        if trace is not None:
+            trace.mark('handler')
         start_response(status, headers)
-        #FIXME: this will make pandas sad :(
+        if self.metrics is not None:
+            self.record(func, status, time.time() - started)
+        if isinstance(body, basestring):
+            return [body]
+        # an iterable body (e.g. `Template.stream`) is passed through as is
+        return body
+
+
+class _Flight(object):
+    """A response being computed, that concurrent misses wait for."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+class ResponseCache(object):
+    """LRU cache of route responses, see `cached`.
+
+    Entries expire after their `ttl`, and the least recently used ones are
+    dropped to keep the cache under `max_size` bytes. Concurrent misses for
+    the same key run the handler once, the other requests wait for its
+    result (or its exception). `hits`, `misses` and `coalesced` count the
+    lookups."""
+
+    def __init__(self, max_size=8 * 1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = self.misses = self.coalesced = 0
+        self._entries = OrderedDict() # key -> (expires, size, result)
+        self._flights = {} # key -> _Flight
+        self._lock = threading.Lock()
+
+    def get(self, key, compute, ttl):
+        """Return the cached result for `key`, or the result of `compute()`
+        cached for `ttl` seconds if it's cacheable."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                if entry[0] > time.time():
+                    self._entries[key] = entry
+                    self.hits += 1
+                    return _copy_result(entry[2])
+                self.size -= entry[1]
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                leader = True
+                self.misses += 1
+            else:
+                leader = False
+                self.coalesced += 1
+
+        if not leader:
+            flight.event.wait()
+            if flight.exc_info is not None:
+                raise flight.exc_info[0], flight.exc_info[1], \
+                        flight.exc_info[2]
+            return _copy_result(flight.result)
+
+        try:
+            result = flight.result = compute()
+        except BaseException:
+            # whatever ends the leader (KeyboardInterrupt, GeneratorExit...)
+            # is raised in the waiters too, they never see a missing result
+            flight.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.event.set()
+        size = _result_size(key, result)
+        if size is not None and size <= self.max_size:
+            with self._lock:
+                old = self._entries.pop(key, None)
+                if old is not None:
+                    self.size -= old[1]
+                self._entries[key] = (time.time() + ttl, size, result)
+                self.size += size
+                while self.size > self.max_size:
+                    self.size -= self._entries.popitem(last=False)[1][1]
+        return _copy_result(result)
+
+    def invalidate(self, path=None):
+        """Drop the responses cached for `path`, whatever their query and
+        headers, or all of them."""
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+                self.size = 0
+                return
+            for key in [key for key in self._entries if key[0] == path]:
+                self.size -= self._entries.pop(key)[1]
+
+    clear = invalidate
+
+response_cache = ResponseCache()
+
+def _copy_result(result):
+    # handlers get their own headers list, free to change it
+    if isinstance(result, tuple):
+        return result[:-2] + (list(result[-2]), result[-1])
+    return result
+
+def _result_size(key, result):
+    """Size in bytes of a route result worth caching: a `200` response with
+    a string body. `None` otherwise."""
+    if isinstance(result, tuple) and len(result) == 3:
+        status, headers, body = result
+        if not status.startswith('200'):
+            return None
+    elif isinstance(result, tuple):
+        headers, body = result
+    else:
+        headers, body = [], result
+    if not isinstance(body, basestring):
+        return None
+    size = len(body) + sum(len(name) + len(value) for name, value in headers)
+    return size + sum(len(part) for part in key[:2]) + 256
+
+def cached(ttl, vary=(), cache=response_cache):
+    """Decorate a route to cache its responses for `ttl` seconds, keyed on
+    the path, the query string and the `vary` request headers. Only `GET`
+    and `HEAD` requests are answered from the cache, and only `200`
+    responses with a string body are kept.
+
+        App({'^/status$': cached(60)(status)})
+    """
+    keys = ['HTTP_' + name.upper().replace('-', '_') for name in vary]
+
+    def decorator(func):
+        def wrapper(environ, **kwargs):
+            if environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+                return func(environ, **kwargs)
+            key = (environ['PATH_INFO'], environ.get('QUERY_STRING', '')) + \
+                    tuple(environ.get(name) for name in keys)
+            return cache.get(key, lambda: func(environ, **kwargs), ttl)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+
+# content types worth compressing
+COMPRESSIBLE = re.compile(r'^(text/|application/(javascript|json|xml)|'
+        r'image/svg\+xml)')
+
+def gzip_compress(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class GzipMiddleware(object):
+    """Gzip the responses of `app` that are at least `min_size` bytes long,
+    when the client accepts it.
+
+    Only complete bodies (lists of strings) with a compressible content type
+    are compressed, streams and files are left alone. What the app passes
+    to the `write` callable is buffered and sent first. The last `cache_size`
+    compressed bodies are kept, keyed by their digest, so repeated
+    responses are compressed only once.
+    """
+
+    def __init__(self, app, min_size=1024, level=6, cache_size=64):
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+        self.cache_size = cache_size
+        self._cache = OrderedDict() # digest -> compressed body
+        self._lock = threading.Lock()
+
+    def compress(self, body):
+        key = hashlib.md5(body).digest()
+        with self._lock:
+            compressed = self._cache.pop(key, None)
+            if compressed is not None:
+                self._cache[key] = compressed
+                return compressed
+        compressed = gzip_compress(body, self.level)
+        with self._lock:
+            self._cache[key] = compressed
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return compressed
+
+    def __call__(self, environ, start_response):
+        response = []
+        written = []
+        def capture(status, headers, exc_info=None):
+            if response is None:
+                # called while the body is iterated, it's passed through
+                return start_response(status, headers, exc_info)
+            response[:] = [status, headers, exc_info]
+            return written.append
+
+        # start_response is delayed until we know if the body gets compressed
+        result = self.app(environ, capture)
+        if not response:
+            # a generator calls start_response when first iterated
+            response = None
+            return result
+        status, headers, exc_info = response
+
+        names = dict((name.lower(), value) for name, value in headers)
+        if not isinstance(result, list) or not status.startswith('200') or \
+                'content-encoding' in names or \
+                not COMPRESSIBLE.match(names.get('content-type', '')):
+            start_response(status, headers, exc_info)
+            if written:
+                return _prepend(written, result)
+            return result
+
+        headers = [h for h in headers if h[0].lower() != 'content-length']
+        headers.append(('Vary', 'Accept-Encoding'))
+        body = ''.join(written + result)
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        accept = environ.get('HTTP_ACCEPT_ENCODING')
+        if len(body) >= self.min_size and utils.accepts_encoding(accept, 'gzip'):
+            body = self.compress(body)
+            headers.append(('Content-Encoding', 'gzip'))
+        headers.append(('Content-Length', str(len(body))))
+        start_response(status, headers, exc_info)
         return [body]
 
+def _prepend(written, result):
+    try:
+        for data in written:
+            yield data
+        for data in result:
+            yield data
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
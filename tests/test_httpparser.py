@@ -0,0 +1,59 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from trabant.httpparser import RequestParser, ParseError
+
+
+def parse(head, by_line=False):
+    """Feed `head` whole, or a line at a time as the threaded server does."""
+    parser = RequestParser()
+    chunks = head.splitlines(True) if by_line else [head]
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser
+
+
+class ContentLengthTest(unittest.TestCase):
+
+    def assertRejected(self, head, status_code=400):
+        for by_line in (False, True):
+            try:
+                parse(head, by_line)
+            except ParseError, e:
+                self.assertEqual(e.status_code, status_code)
+            else:
+                self.fail('%r accepted (by_line=%s)' % (head, by_line))
+
+    def test_valid(self):
+        for by_line in (False, True):
+            parser = parse('POST / HTTP/1.1\r\nContent-Length: 5\r\n\r\n',
+                    by_line)
+            self.assertTrue(parser.complete)
+            self.assertEqual(parser.environ['CONTENT_LENGTH'], '5')
+
+    def test_not_numeric(self):
+        self.assertRejected('POST / HTTP/1.1\r\nContent-Length: 5x\r\n\r\n')
+        self.assertRejected('POST / HTTP/1.1\r\nContent-Length: -1\r\n\r\n')
+
+    def test_folded(self):
+        self.assertRejected(
+                'POST / HTTP/1.1\r\nContent-Length: 5\r\n 0\r\n\r\n')
+        self.assertRejected(
+                'POST / HTTP/1.1\r\nContent-Length: 5\r\n\t0\r\n\r\n')
+        self.assertRejected('POST / HTTP/1.1\r\nHost: a\r\n'
+                'Content-Length: 5\r\n 0\r\nAccept: */*\r\n\r\n')
+
+    def test_conflicting(self):
+        self.assertRejected('POST / HTTP/1.1\r\nContent-Length: 5\r\n'
+                'Content-Length: 6\r\n\r\n')
+
+    def test_other_headers_fold(self):
+        for by_line in (False, True):
+            parser = parse('GET / HTTP/1.1\r\nX-A: b\r\n c\r\n\r\n', by_line)
+            self.assertEqual(parser.environ['HTTP_X_A'], 'b c')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import os
+import sys
+import socket
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from trabant import async_server, threaded_server
+
+
+def app(environ, start_response):
+    body = 'hello %s %s' % (environ['PATH_INFO'], environ['QUERY_STRING'])
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+        ('Content-Length', str(len(body)))])
+    return [body]
+
+
+class SmugglingMixIn(object):
+    """Bodies are framed by Content-Length only, a chunked one must not be
+    read as the next request."""
+
+    def exchange(self, data):
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        sock.settimeout(5)
+        try:
+            sock.sendall(data)
+            received = []
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                received.append(chunk)
+        finally:
+            sock.close()
+        return ''.join(received)
+
+    def test_chunked_body(self):
+        response = self.exchange('POST / HTTP/1.1\r\nHost: a\r\n'
+                'Transfer-Encoding: chunked\r\n\r\n'
+                '0\r\n\r\nGET /admin?x=smuggled HTTP/1.1\r\nHost: a\r\n\r\n')
+        self.assertTrue(response.startswith('HTTP/1.1 501 '), response)
+        self.assertNotIn('/admin', response)
+
+    def test_chunked_body_with_length(self):
+        data = 'GET /admin?x=smuggled HTTP/1.1\r\nHost: a\r\n\r\n'
+        response = self.exchange('POST / HTTP/1.1\r\nHost: a\r\n'
+                'Transfer-Encoding: chunked\r\nContent-Length: %d\r\n\r\n'
+                '0\r\n\r\n%s' % (5 + len(data), data))
+        self.assertTrue(response.startswith('HTTP/1.1 400 '), response)
+        self.assertNotIn('/admin', response)
+
+    def test_keep_alive(self):
+        response = self.exchange('POST /a HTTP/1.1\r\nContent-Length: 3\r\n'
+                '\r\nabcGET /b HTTP/1.1\r\nConnection: close\r\n\r\n')
+        self.assertIn('hello /a', response)
+        self.assertIn('hello /b', response)
+
+
+class AsyncServerTest(SmugglingMixIn, unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.loop = async_server.EventLoop()
+        cls.loop.add_waker()
+        cls.server = async_server.HTTPServer(app, '127.0.0.1', 0,
+                loop=cls.loop)
+        cls.port = cls.server.socket.getsockname()[1]
+        cls.thread = threading.Thread(target=cls.server.run, args=(0.1,))
+        cls.thread.daemon = True
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.loop.call_soon_threadsafe(cls.server.stop)
+        cls.thread.join(5)
+
+
+class ThreadedServerTest(SmugglingMixIn, unittest.TestCase):
+
+    pool_size = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = threaded_server.ThreadedWSGIServer(app, '127.0.0.1', 0,
+                pool_size=cls.pool_size)
+        cls.port = cls.server.socket.getsockname()[1]
+        cls.thread = threading.Thread(target=cls.server.run)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        cls.thread.join(5)
+
+
+class PooledServerTest(ThreadedServerTest):
+
+    pool_size = 2
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from trabant.template import Renderer
+
+
+class TemplateTest(unittest.TestCase):
+
+    templates = {
+        'layout.tpl': '<html>{{title}}\n%include\n</html>\n',
+        'late.tpl': '%for i in range(5):\nline {{i}}\n%end\n'
+                '%rebase layout title="T"\n',
+        'early.tpl': '%rebase layout title="T"\n'
+                '%for i in range(5):\nline {{i}}\n%end\n',
+        'plain.tpl': '%for i in range(5):\nline {{i}}\n%end\n',
+        'locals.tpl': '%x = 1\n{{sorted(k for k in locals() if k in '
+                '("title", "x"))}}\n%def f(a):\n%return sorted(locals())\n'
+                '%end\n{{f(2)}}\n',
+    }
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        for name, source in self.templates.items():
+            with open(os.path.join(self.path, name), 'w') as f:
+                f.write(source)
+        self.renderer = Renderer(self.path, ext='tpl')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_rebase_matches_render(self):
+        for name in ('late', 'early'):
+            t = self.renderer.lookup(name)
+            rendered = t.render()
+            self.assertTrue(rendered.startswith('<html>T\nline 0\n'),
+                    rendered)
+            chunks = list(t.stream(_bufsize=4))
+            self.assertEqual(''.join(chunks), rendered)
+
+    def test_plain_streams(self):
+        t = self.renderer.lookup('plain')
+        chunks = list(t.stream(_bufsize=4))
+        self.assertEqual(''.join(chunks), t.render())
+        self.assertEqual(len(chunks), 5)
+
+    def test_locals(self):
+        t = self.renderer.lookup('locals')
+        expected = u"['title', 'x']\n['a']\n"
+        self.assertEqual(t.render(title='T'), expected)
+        self.assertEqual(''.join(t.stream(title='T')), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()